@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of raw feed responses, keyed by url. Each entry is a file
+made of a JSON header line (url, headers, time) followed by the body.
+Files are touched when read, the least recently used ones are removed
+once the cache grows over max_size bytes.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from hashlib import sha1
+
+logger = logging.getLogger('bear.cache')
+
+
+class ResponseCache:
+    def __init__(self, path, max_size=104857600, ttl=3600):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._size = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key_path(self, url):
+        return os.path.join(
+            self.path, '%s.cache' % sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url, max_age=None):
+        """
+        Return (headers, body, age) of url, or None when missing or
+        older than max_age seconds (ttl by default).
+        """
+        if max_age is None:
+            max_age = self.ttl
+        path = self.key_path(url)
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline().decode('utf-8'))
+                body = f.read()
+        except (IOError, OSError, ValueError):
+            return None
+        age = time.time() - meta['time']
+        if meta['url'] != url or age > max_age:
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return meta['headers'], body, age
+
+    def put(self, url, headers, body):
+        path = self.key_path(url)
+        meta = json.dumps({'url': url, 'headers': headers, 'time': time.time()})
+        tmp_path = '%s.%s.tmp' % (path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(meta.encode('utf-8') + b'\n')
+            f.write(body)
+            size = f.tell()
+        try:
+            previous = os.path.getsize(path)
+        except OSError:
+            previous = 0
+        os.rename(tmp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self.scan()[1]
+            else:
+                self._size += size - previous
+            if self._size > self.max_size:
+                self.evict()
+
+    def scan(self):
+        """Return (mtime, size, path) of cached files and their total size."""
+        files = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.cache'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files, sum(f[1] for f in files)
+
+    def evict(self):
+        # Other processes may share the cache, sizes are read again
+        files, self._size = self.scan()
+        files.sort()
+        for mtime, size, path in files:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+            logger.debug('[cache] %s evicted' % path)
@@ -1,24 +1,85 @@
 # -*- coding: utf-8 -*-
 import sys
 import logging
-import smtplib
-import feedparser
+import threading
+from os import getpid
+from time import time
+from time import sleep
 from time import mktime
+from functools import wraps
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
 from datetime import datetime
+from datetime import timedelta
+from socket import gethostname
+from uuid import uuid4
+from peewee import fn
+from peewee import OP
+from peewee import Expression
+from peewee import chunked
+from peewee import BaseQuery
 from peewee import SqliteDatabase
-from email.mime.text import MIMEText
-from colorlog import ColoredFormatter
 
 try:
     from ConfigParser import ConfigParser
 except ImportError:
     from configparser import ConfigParser
 
+from .feed import MODELS
+from .feed import database
+from .metrics import Metrics
+from .migrations import migrate_db
+from .scheduler import Scheduler
+from .scheduler import parse_retry_after
 from .plugins import PluginManager
 
 PY2 = sys.version_info[0] == 2
 
 
+def bound(func):
+    """
+    Bind models to the instance database in the current thread while
+    func runs, so several Bear instances can live in the same process.
+    """
+    @wraps(func)
+    def inner(self, *args, **kwargs):
+        with database.bind(self.db):
+            result = func(self, *args, **kwargs)
+        if isinstance(result, BaseQuery):
+            # Queries are run later, on the database of the instance
+            result = result.bind(self.db)
+        return result
+    return inner
+
+
+def parse_shard(value):
+    """Return (index, count) of a shard written as index/count."""
+    if not value:
+        return None
+    try:
+        index, count = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise ValueError('shard must be written as index/count (ie: 0/4)')
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('shard index must be between 0 and %s' % (count - 1))
+    return index, count
+
+
+def email_body(entry):
+    """Default email message of an entry, before plugins."""
+    return '<strong><a href="%s">Go to website</a></strong><hr> %s' % (
+        entry.link, entry.description)
+
+
+def digest_body(entries):
+    """Default digest message of entries, before plugins."""
+    return ''.join(
+        '<h3><a href="%s">%s</a></h3>%s<hr>' % (
+            e.link, e.title, e.description) for e in entries)
+
+
 class Bear:
     def __init__(self, settings_path="bear.ini", cli_opts={}):
         self.cli_opts = cli_opts
@@ -34,29 +95,174 @@ class Bear:
         self.smtp_user = self.config.get('email', 'user')
         self.smtp_pass = self.config.get('email', 'pass')
 
-        self._smtp_conn = None
+        self._mailer = None
+        self._hosts = None
+        self._cache = None
+        # Hosts and cache are first used from fetch workers
+        self._lock = threading.Lock()
+        self._scheduler_loaded = None
+        self.metrics = Metrics(
+            path=self.config.get('metrics', 'file'),
+            prometheus_path=self.config.get('metrics', 'prometheus_file'))
+        self.scheduler = Scheduler(
+            min_interval=self.config.getint('daemon', 'min_interval'),
+            max_interval=self.config.getint('daemon', 'max_interval'),
+            default_interval=self.config.getint('daemon', 'default_interval'))
+        # Runners sharing a database are told apart by their node name
+        self.node = self.config.get('cluster', 'node') or '%s-%s-%s' % (
+            gethostname(), getpid(), uuid4().hex[:8])
+        self.shard = parse_shard(self.config.get('cluster', 'shard'))
 
     def __del__(self):
-        self.db.close()
+        self.close()
+
+    def close(self):
+        if getattr(self, 'plugin_manager', None) is not None:
+            self.plugin_manager.close()
+        if getattr(self, '_mailer', None) is not None:
+            self._mailer.close()
+            self._mailer = None
+        if getattr(self, '_hosts', None) is not None:
+            self._hosts.close()
+        if hasattr(self, 'db'):
+            self.db.close()
 
     @property
-    def smtp_conn(self):
+    def mailer(self):
         if not self.config.get('email', 'to'):
             raise Exception('Missing "to" option in "email" section.')
-        if self._smtp_conn is None:
-            self._smtp_conn = smtplib.SMTP(self.smtp_host, self.smtp_port)
-            self._smtp_conn.ehlo()
-            if self.smtp_tls:
-                self._smtp_conn.starttls()
-            if self.smtp_user:
-                self._smtp_conn.login(self.smtp_user, self.smtp_pass)
-        return self._smtp_conn
+        if self._mailer is None:
+            from .mailer import Mailer
+            self._mailer = Mailer(
+                self.smtp_host, self.smtp_port,
+                tls=self.smtp_tls,
+                user=self.smtp_user,
+                password=self.smtp_pass,
+                pool_size=self.config.getint('email', 'pool_size'),
+                max_per_connection=self.config.getint(
+                    'email', 'max_per_connection'),
+                timeout=self.config.getint('email', 'timeout'))
+        return self._mailer
+
+    @property
+    def hosts(self):
+        # Shared by fetch workers, see Hosts
+        with self._lock:
+            if self._hosts is None:
+                from .hosts import Hosts
+                self._hosts = Hosts(
+                    max_connections=self.config.getint('fetch', 'host_connections'),
+                    delay=self.config.getfloat('fetch', 'host_delay'),
+                    max_wait=self.config.getint('fetch', 'timeout'))
+            return self._hosts
+
+    @property
+    def cache(self):
+        # Responses cache, None unless a cache dir is set
+        with self._lock:
+            if self._cache is None and self.config.get('cache', 'dir'):
+                from .cache import ResponseCache
+                self._cache = ResponseCache(
+                    self.config.get('cache', 'dir'),
+                    max_size=self.config.getint('cache', 'max_size'),
+                    ttl=self.config.getint('cache', 'ttl'))
+            return self._cache
+
+    @bound
+    def flush_outbox(self, deadline=None):
+        """
+        Send due messages of the outbox and return the number sent.
+        Messages not sent before the deadline timestamp are left for
+        the next run.
+        """
+        from .feed import Outbox
+
+        if not self.config.get('email', 'to'):
+            return 0
+        if deadline is not None and time() >= deadline:
+            self.logger.warning('[outbox] deadline reached, emails left for the next run')
+            return 0
+
+        retry_delay = self.config.getint('email', 'retry_delay')
+        max_attempts = self.config.getint('email', 'max_attempts')
+        now = datetime.now()
+        due = (Outbox.status == 'pending') & (Outbox.next_attempt <= now)
+        ids = [m.id for m in Outbox.select(Outbox.id).where(due)]
+        if not ids:
+            return 0
+
+        # Messages are leased by pushing their next attempt back, other
+        # runners skip them and pick them up if this one dies meanwhile
+        until = now + timedelta(seconds=self.config.getint('cluster', 'lease'))
+        messages = []
+        with self.atomic():
+            for chunk in chunked(ids, 500):
+                Outbox.update(locked_by=self.node, next_attempt=until).where(
+                    Outbox.id.in_(chunk), due).execute()
+                messages.extend(Outbox.select().where(
+                    Outbox.id.in_(chunk), Outbox.status == 'pending',
+                    Outbox.locked_by == self.node).order_by(Outbox.id))
+        if not messages:
+            return 0
+
+        # Delivery runs on mailer threads, rows are only updated here
+        # once every message has been handled or the deadline is reached
+        for message in messages:
+            self.mailer.send(
+                message.sender, message.to.split(','), message.message,
+                message_id=message.id)
+        results = dict((r[0], r[1:]) for r in self.mailer.flush(deadline))
+
+        sent = failed = 0
+        with self.atomic():
+            for message in messages:
+                if message.id not in results:
+                    # Still being sent at the deadline, kept leased
+                    continue
+                error, seconds = results[message.id]
+                if seconds is None:
+                    # Dropped at the deadline, no attempt made
+                    message.locked_by = None
+                    message.next_attempt = datetime.now()
+                    message.save()
+                    continue
+                stats = self.metrics.feed(message.feed_id)
+                stats.observe('smtp', seconds)
+                if error is None:
+                    message.delete_instance()
+                    stats.incr('sent')
+                    sent += 1
+                    continue
+                stats.incr('errors')
+                failed += 1
+                message.attempts += 1
+                message.last_error = str(error)
+                message.locked_by = None
+                if message.attempts >= max_attempts:
+                    message.status = 'failed'
+                    self.logger.error('[outbox-%s] given up after %s attempts' % (
+                        message.id, message.attempts))
+                else:
+                    message.next_attempt = datetime.now() + timedelta(
+                        seconds=retry_delay * 2 ** (message.attempts - 1))
+                message.save()
+
+        self.logger.info('[outbox] %s email(s) sent, %s failed' % (sent, failed))
+        return sent
 
     def load_cli_options(self):
         if self.cli_opts.get('--log-level'):
             self.config['settings']['log_level'] = self.cli_opts.get('--log-level')
         if self.cli_opts.get('--no-email'):
             self.config['email']['to'] = ''
+        if self.cli_opts.get('--batch'):
+            self.config['email']['batch'] = 'True'
+        if self.cli_opts.get('--workers'):
+            self.config['settings']['workers'] = self.cli_opts.get('--workers')
+        if self.cli_opts.get('--shard'):
+            self.config['cluster']['shard'] = self.cli_opts.get('--shard')
+        if self.cli_opts.get('--deadline'):
+            self.config['settings']['deadline'] = self.cli_opts.get('--deadline')
 
     def load_logger(self):
         level = self.config.get('settings', 'log_level').lower()
@@ -81,19 +287,24 @@ class Bear:
         console = logging.StreamHandler()
         console.setLevel(level)
 
-        logger_format = "%(log_color)s%(message)s"
+        logger_format = '%(message)s'
         if level == logging.DEBUG:
-            logger_format = '%(log_color)s%(name)s:%(levelname)-5s %(message)s'
-        formatter = ColoredFormatter(
-            logger_format,
-            datefmt=None,
-            reset=True,
-            log_colors={
-                'DEBUG': 'cyan',
-                'INFO': 'green',
-                'WARNING': 'yellow',
-                'ERROR': 'red',
-                'CRITICAL': 'red'})
+            logger_format = '%(name)s:%(levelname)-5s %(message)s'
+        if console.stream.isatty():
+            # Colors are only worth importing colorlog for a terminal
+            from colorlog import ColoredFormatter
+            formatter = ColoredFormatter(
+                '%(log_color)s' + logger_format,
+                datefmt=None,
+                reset=True,
+                log_colors={
+                    'DEBUG': 'cyan',
+                    'INFO': 'green',
+                    'WARNING': 'yellow',
+                    'ERROR': 'red',
+                    'CRITICAL': 'red'})
+        else:
+            formatter = logging.Formatter(logger_format)
         console.setFormatter(formatter)
         logging.getLogger('').addHandler(console)
 
@@ -106,7 +317,10 @@ class Bear:
                 conf[plugin] = {}
                 if self.config.has_section('plugin:%s' % plugin):
                     conf[plugin] = self.config['plugin:%s' % plugin]
-        self.plugin_manager = PluginManager(conf)
+        self.plugin_manager = PluginManager(
+            conf,
+            workers=self.config.getint('settings', 'plugin_workers'),
+            timeout=self.config.getint('settings', 'plugin_timeout'))
 
     def load_settings(self):
         self.config = ConfigParser()
@@ -117,12 +331,100 @@ class Bear:
             self.config.add_section('settings')
         if not self.config.has_option('settings', 'db_path'):
             self.config.set('settings', 'db_path', 'bear.db')
+        if not self.config.has_option('settings', 'db_url'):
+            self.config.set('settings', 'db_url', '')
         if not self.config.has_option('settings', 'plugins'):
             self.config.set('settings', 'plugins', '')
         if not self.config.has_option('settings', 'log_file'):
             self.config.set('settings', 'log_file', 'bear.log')
         if not self.config.has_option('settings', 'log_level'):
             self.config.set('settings', 'log_level', 'INFO')
+        if not self.config.has_option('settings', 'journal_mode'):
+            self.config.set('settings', 'journal_mode', 'wal')
+        if not self.config.has_option('settings', 'synchronous'):
+            self.config.set('settings', 'synchronous', 'normal')
+        if not self.config.has_option('settings', 'cache_size'):
+            self.config.set('settings', 'cache_size', '-16000')
+        if not self.config.has_option('settings', 'mmap_size'):
+            self.config.set('settings', 'mmap_size', '67108864')
+        if not self.config.has_option('settings', 'busy_timeout'):
+            self.config.set('settings', 'busy_timeout', '10')
+        if not self.config.has_option('settings', 'workers'):
+            self.config.set('settings', 'workers', '4')
+        if not self.config.has_option('settings', 'seen_retention'):
+            self.config.set('settings', 'seen_retention', '30')
+        if not self.config.has_option('settings', 'seen_keep'):
+            self.config.set('settings', 'seen_keep', '1000')
+        if not self.config.has_option('settings', 'plugin_workers'):
+            self.config.set('settings', 'plugin_workers', '4')
+        if not self.config.has_option('settings', 'plugin_timeout'):
+            self.config.set('settings', 'plugin_timeout', '30')
+        if not self.config.has_option('settings', 'deadline'):
+            self.config.set('settings', 'deadline', '0')
+        if not self.config.has_option('settings', 'lock_file'):
+            self.config.set('settings', 'lock_file', '')
+
+        # Daemon
+        if not self.config.has_section('daemon'):
+            self.config.add_section('daemon')
+        if not self.config.has_option('daemon', 'min_interval'):
+            self.config.set('daemon', 'min_interval', '300')
+        if not self.config.has_option('daemon', 'max_interval'):
+            self.config.set('daemon', 'max_interval', '86400')
+        if not self.config.has_option('daemon', 'default_interval'):
+            self.config.set('daemon', 'default_interval', '1800')
+        if not self.config.has_option('daemon', 'refresh'):
+            self.config.set('daemon', 'refresh', '300')
+
+        # Fetch
+        if not self.config.has_section('fetch'):
+            self.config.add_section('fetch')
+        if not self.config.has_option('fetch', 'timeout'):
+            self.config.set('fetch', 'timeout', '30')
+        if not self.config.has_option('fetch', 'connect_timeout'):
+            self.config.set('fetch', 'connect_timeout', '10')
+        if not self.config.has_option('fetch', 'max_size'):
+            self.config.set('fetch', 'max_size', '10485760')
+        if not self.config.has_option('fetch', 'stream'):
+            self.config.set('fetch', 'stream', 'True')
+        if not self.config.has_option('fetch', 'stop_after'):
+            self.config.set('fetch', 'stop_after', '3')
+        if not self.config.has_option('fetch', 'host_connections'):
+            self.config.set('fetch', 'host_connections', '2')
+        if not self.config.has_option('fetch', 'host_delay'):
+            self.config.set('fetch', 'host_delay', '1')
+        if not self.config.has_option('fetch', 'max_errors'):
+            self.config.set('fetch', 'max_errors', '10')
+
+        # Cache
+        if not self.config.has_section('cache'):
+            self.config.add_section('cache')
+        if not self.config.has_option('cache', 'dir'):
+            self.config.set('cache', 'dir', '')
+        if not self.config.has_option('cache', 'max_size'):
+            self.config.set('cache', 'max_size', '104857600')
+        if not self.config.has_option('cache', 'ttl'):
+            self.config.set('cache', 'ttl', '3600')
+
+        # Cluster
+        if not self.config.has_section('cluster'):
+            self.config.add_section('cluster')
+        if not self.config.has_option('cluster', 'node'):
+            self.config.set('cluster', 'node', '')
+        if not self.config.has_option('cluster', 'shard'):
+            self.config.set('cluster', 'shard', '')
+        if not self.config.has_option('cluster', 'lease'):
+            self.config.set('cluster', 'lease', '600')
+        if not self.config.has_option('cluster', 'claim_size'):
+            self.config.set('cluster', 'claim_size', '50')
+
+        # Metrics
+        if not self.config.has_section('metrics'):
+            self.config.add_section('metrics')
+        if not self.config.has_option('metrics', 'file'):
+            self.config.set('metrics', 'file', '')
+        if not self.config.has_option('metrics', 'prometheus_file'):
+            self.config.set('metrics', 'prometheus_file', '')
 
         # Email
         if not self.config.has_section('email'):
@@ -141,49 +443,186 @@ class Bear:
             self.config.set('email', 'user', '')
         if not self.config.has_option('email', 'pass'):
             self.config.set('email', 'pass', '')
+        if not self.config.has_option('email', 'pool_size'):
+            self.config.set('email', 'pool_size', '2')
+        if not self.config.has_option('email', 'max_per_connection'):
+            self.config.set('email', 'max_per_connection', '100')
+        if not self.config.has_option('email', 'batch'):
+            self.config.set('email', 'batch', 'False')
+        if not self.config.has_option('email', 'retry_delay'):
+            self.config.set('email', 'retry_delay', '60')
+        if not self.config.has_option('email', 'max_attempts'):
+            self.config.set('email', 'max_attempts', '5')
+        if not self.config.has_option('email', 'timeout'):
+            self.config.set('email', 'timeout', '30')
 
     def initialize_config(self):
         self.config.write(open(self.settings_path, 'w'))
 
     def initialize_db(self):
-        self.db = SqliteDatabase(
-            self.config.get('settings', 'db_path'))
+        url = self.config.get('settings', 'db_url')
+        options = {}
+        if not url or url.startswith('sqlite'):
+            pragmas = []
+            for pragma in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size'):
+                value = self.config.get('settings', pragma)
+                if value:
+                    pragmas.append((pragma, value))
+            options['pragmas'] = pragmas
+            options['timeout'] = self.config.getint('settings', 'busy_timeout')
+
+        if url:
+            from playhouse.db_url import connect
+            self.db = connect(url, **options)
+        else:
+            self.db = SqliteDatabase(
+                self.config.get('settings', 'db_path'), **options)
         self.db.connect()
 
-        global DB
-        DB = self.db
+        # Last initialized database is the default one for code
+        # using models outside of Bear methods
+        database.initialize(self.db)
+        with database.bind(self.db):
+            migrate_db(self.db, MODELS)
+
+    def atomic(self):
+        """
+        Write transaction. SQLite write lock is taken upfront so
+        concurrent runners wait for it (busy_timeout) instead of
+        failing to upgrade a read transaction.
+        """
+        if isinstance(self.db, SqliteDatabase):
+            return self.db.atomic('IMMEDIATE')
+        return self.db.atomic()
+
+    def sharded(self, query):
+        from .feed import Feed
+
+        if self.shard is None:
+            return query
+        index, count = self.shard
+        if isinstance(self.db, SqliteDatabase):
+            # No MOD function in most SQLite builds
+            return query.where(Expression(Feed.id, OP.MOD, count) == index)
+        return query.where(fn.MOD(Feed.id, count) == index)
+
+    @bound
+    def claim_feeds(self, limit, *conditions):
+        """
+        Lease up to limit feeds matching conditions to this node and
+        return them. Feeds leased by other nodes are skipped until their
+        lease expires, feeds of crashed runners are then claimed again.
+        """
+        from .feed import Feed
+
+        now = datetime.now()
+        free = Feed.lease_until.is_null() | (Feed.lease_until <= now)
+        candidates = list(self.sharded(
+            Feed.select(Feed.id, Feed.locked_by).where(free, *conditions)
+        ).order_by(Feed.id).limit(limit))
+        if not candidates:
+            return []
+
+        expired = len([f for f in candidates if f.locked_by])
+        if expired:
+            self.logger.warning('[cluster] %s expired lease(s) reclaimed' % expired)
+        ids = [f.id for f in candidates]
+        until = now + timedelta(seconds=self.config.getint('cluster', 'lease'))
+        with self.atomic():
+            Feed.update(locked_by=self.node, lease_until=until).where(
+                Feed.id.in_(ids), free).execute()
+            return list(Feed.select().where(
+                Feed.id.in_(ids), Feed.locked_by == self.node).order_by(Feed.id))
 
+    def _lease_lost(self, feed):
+        """
+        Release the lease of a claimed feed, return True if another
+        node took it over meanwhile.
+        """
         from .feed import Feed
-        if not Feed.table_exists():
-            Feed.create_table()
 
+        if feed.locked_by is not None and not Feed.select().where(
+                (Feed.id == feed.id) & (Feed.locked_by == feed.locked_by)).exists():
+            self.logger.warning('[feed-%s] lease lost, result dropped' % feed.id)
+            return True
+        feed.locked_by = None
+        feed.lease_until = None
+        feed.last_polled = datetime.now()
+        return False
+
+    @bound
     def add_feed(self, url):
         url = self.plugin_manager.run_signal('pre_add_feed', url)
 
         from .feed import Feed
-        if not Feed.select(Feed.url).where(Feed.url == url).count():
-            f = Feed(url=url)
-            f.save()
+        feed = self.get_feed(url=url)
+        if feed is None:
+            f = Feed.create(url=url)
             f = self.plugin_manager.run_signal('post_add_feed', f)
             self.logger.info('[feed-%s] added (%s)' % (f.id, f.url))
             return f.id
         f = self.plugin_manager.run_signal('post_add_feed', None)
-        feed = Feed.select().where(Feed.url == url).get()
         self.logger.info('[feed-%s] already exists (%s)' % (feed.id, feed.url))
         return f
 
+    @bound
+    def import_feeds(self, urls):
+        """
+        Add many feeds at once, existing ones are found with one query
+        and new ones are inserted in a single transaction.
+        """
+        from .feed import Feed
+
+        # Plugins can process the whole batch at once, ie concurrently
+        urls = self.plugin_manager.run_signal('pre_add_feeds', list(urls))
+        unique = []
+        found = set()
+        for url in urls:
+            url = self.plugin_manager.run_signal('pre_add_feed', url)
+            if url and url not in found:
+                found.add(url)
+                unique.append(url)
+
+        existing = set()
+        for chunk in chunked(unique, 500):
+            existing.update(f.url for f in Feed.select(Feed.url).where(
+                Feed.url.in_(chunk)))
+        new = [url for url in unique if url not in existing]
+
+        now = datetime.now()
+        with self.atomic():
+            for chunk in chunked(new, 100):
+                Feed.insert_many(
+                    [{'url': url, 'added': now} for url in chunk]).execute()
+
+        feed_ids = []
+        for chunk in chunked(new, 500):
+            for f in Feed.select().where(Feed.url.in_(chunk)):
+                f = self.plugin_manager.run_signal('post_add_feed', f)
+                self.logger.info('[feed-%s] added (%s)' % (f.id, f.url))
+                feed_ids.append(f.id)
+        for url in existing:
+            self.plugin_manager.run_signal('post_add_feed', None)
+            self.logger.info('[feed] already exists (%s)' % url)
+
+        self.logger.info('[import] %s feed(s) added, %s already exist' % (
+            len(feed_ids), len(existing)))
+        return feed_ids
+
+    @bound
     def delete_feed(self, feed_id=None):
         feed = self.get_feed(feed_id=feed_id)
         feed = self.plugin_manager.run_signal('pre_delete_feed', feed)
 
         if feed is not None:
             self.logger.info('[feed-%s] deleted (%s)' % (feed.id, feed.url))
-            feed.delete_instance()
+            feed.delete_instance(recursive=True)
         else:
             self.logger.info('[feed-%s] not exists' % feed_id)
 
         feed = self.plugin_manager.run_signal('post_delete_feed', feed)
 
+    @bound
     def get_feed(self, feed_id=None, url=None):
         from .feed import Feed
         assert any(v is not None for v in [feed_id, url])
@@ -198,18 +637,44 @@ class Bear:
         except Feed.DoesNotExist:
             return None
 
-    def get_feeds(self):
+    @bound
+    def get_feeds(self, failing=False):
         from .feed import Feed
+        if failing:
+            return Feed.select().where(
+                (Feed.errors > 0) | (Feed.disabled == True)).order_by(
+                Feed.errors.desc(), Feed.id)
         return Feed.select()
 
+    @bound
+    def health(self):
+        """Return the number of feeds by latest fetch status."""
+        from .feed import Feed
+        counts = dict(
+            (status or 'never', count) for status, count in Feed.select(
+                Feed.last_status, fn.COUNT(Feed.id)).group_by(
+                Feed.last_status).tuples())
+        counts['disabled'] = Feed.select().where(Feed.disabled == True).count()
+        return counts
+
+    @bound
     def reset_feed(self, feed_id=None):
         feed = self.get_feed(feed_id=feed_id)
         self.logger.debug('[feed-%s] Fire pre_reset_feed event' % feed_id)
         feed = self.plugin_manager.run_signal('pre_reset_feed', feed)
 
         if feed is not None:
+            from .feed import SeenEntry
+            SeenEntry.delete().where(SeenEntry.feed == feed).execute()
             feed.updated = None
             feed.latest_id = None
+            # Fetched again from scratch, even if not modified
+            feed.etag = None
+            feed.modified = None
+            feed.digest = None
+            feed.newest_first = None
+            feed.errors = 0
+            feed.disabled = False
             feed.save()
             self.logger.info('[feed-%s] reseted' % feed.id)
         else:
@@ -218,76 +683,480 @@ class Bear:
         feed = self.plugin_manager.run_signal('post_reset_feed', feed)
 
     def send_email(self, feed, feed_parsed, entry):
-        message = '<strong><a href="%s">Go to website</a></strong><hr> %s' % (
-            entry.link, entry.description)
-        (sender, to, subject, message,
-            feed, feed_parsed, entry) = self.plugin_manager.run_signal(
-            'pre_send_email',
-            self.config.get('email', 'from'),
-            self.config.get('email', 'to'),
-            '[%s] %s' % (feed_parsed.feed.title, entry.title),
-            message,
-            feed,
-            feed_parsed,
-            entry)
-
-        if PY2:
-            message = message.encode('utf-8')
-        msg = MIMEText(message, 'html')
-        msg['Subject'] = subject
-        msg['From'] = sender
-        msg['To'] = to
-        if self.config.get('email', 'to'):
-            self.smtp_conn.sendmail(sender, to.split(','), msg.as_string())
-            return True
+        message = email_body(entry)
+        with self.metrics.feed(feed.id).timer('plugins'):
+            (sender, to, subject, message,
+                feed, feed_parsed, entry) = self.plugin_manager.run_signal(
+                'pre_send_email',
+                self.config.get('email', 'from'),
+                self.config.get('email', 'to'),
+                '[%s] %s' % (feed_parsed.feed.title, entry.title),
+                message,
+                feed,
+                feed_parsed,
+                entry)
+
+        return self.queue_email(feed, sender, to, subject, message)
+
+    def send_digest(self, feed, feed_parsed, entries):
+        message = digest_body(entries)
+        with self.metrics.feed(feed.id).timer('plugins'):
+            (sender, to, subject, message,
+                feed, feed_parsed, entries) = self.plugin_manager.run_signal(
+                'pre_send_digest',
+                self.config.get('email', 'from'),
+                self.config.get('email', 'to'),
+                '[%s] %s new entries' % (feed_parsed.feed.title, len(entries)),
+                message,
+                feed,
+                feed_parsed,
+                entries)
+
+        return self.queue_email(feed, sender, to, subject, message)
+
+    @bound
+    def queue_email(self, feed, sender, to, subject, message):
+        from email.mime.text import MIMEText
+        from .feed import Outbox
+
+        stats = self.metrics.feed(feed.id)
+        with stats.timer('render'):
+            if PY2:
+                message = message.encode('utf-8')
+            msg = MIMEText(message, 'html')
+            msg['Subject'] = subject
+            msg['From'] = sender
+            msg['To'] = to
+            if self.config.get('email', 'to'):
+                Outbox.create(
+                    feed=feed, sender=sender, to=to, message=msg.as_string())
+                stats.incr('emails')
+                return True
         return False
 
-    def fetch_feed(self, feed_id=None):
-        feed = self.get_feed(feed_id=feed_id)
-        email_count = 0
+    @bound
+    def new_entries(self, feed, entries):
+        """
+        Return entries never seen for this feed and mark them as seen,
+        with a single lookup in the seen entries index.
+        """
+        from .feed import SeenEntry, entry_hash
 
-        if feed is not None:
-            self.logger.info('[feed-%s] fetching feed (%s)' % (feed.id, feed.url))
-            d = feedparser.parse(feed.url)
-            updated = d.feed.get('updated_parsed') or d.feed.get('published_parsed')
-            if updated is None:
-                updated = datetime.now()
-                #self.logger.error('[feed-%s] not well formatted (ignored)' % feed.id)
-                #return
-            else:
-                updated = datetime.fromtimestamp(mktime(updated))
+        hashes = [entry_hash(e.get('id', e.get('link'))) for e in entries]
+        seen = set()
+        for chunk in chunked(hashes, 500):
+            seen.update(s.entry_hash for s in SeenEntry.select(
+                SeenEntry.entry_hash).where(
+                (SeenEntry.feed == feed) & SeenEntry.entry_hash.in_(chunk)))
+
+        # Feeds fetched before the seen index existed only know
+        # their latest entry, everything after it is already sent
+        if not seen and feed.latest_id and not SeenEntry.select().where(
+                SeenEntry.feed == feed).exists():
+            latest = entry_hash(feed.latest_id)
+            if latest in hashes:
+                seen.update(hashes[hashes.index(latest):])
+
+        new = []
+        for h, e in zip(hashes, entries):
+            if h not in seen:
+                seen.add(h)
+                new.append((h, e))
 
-            if feed.updated is not None and updated <= feed.updated:
-                self.logger.info('[feed-%s] no updates found' % feed.id)
+        now = datetime.now()
+        for chunk in chunked(new, 100):
+            SeenEntry.insert_many(
+                [{'feed': feed, 'entry_hash': h, 'seen': now} for h, _ in chunk]
+            ).execute()
+
+        # Forget entries seen more than seen_retention days ago,
+        # always keeping the seen_keep latest ones of the feed
+        keep = self.config.getint('settings', 'seen_keep')
+        retention = self.config.getint('settings', 'seen_retention')
+        oldest_kept = SeenEntry.select(SeenEntry.id).where(
+            SeenEntry.feed == feed).order_by(
+            SeenEntry.id.desc()).offset(keep).limit(1).scalar()
+        if oldest_kept is not None:
+            SeenEntry.delete().where(
+                (SeenEntry.feed == feed) &
+                (SeenEntry.id <= oldest_kept) &
+                (SeenEntry.seen < now - timedelta(days=retention))).execute()
+
+        return [e for _, e in new]
+
+    @bound
+    def seen_hashes(self, feed):
+        from .feed import SeenEntry, entry_hash
+
+        if feed.updated is None:
+            return set()
+        seen = set(s.entry_hash for s in SeenEntry.select(
+            SeenEntry.entry_hash).where(SeenEntry.feed == feed))
+        if feed.latest_id:
+            seen.add(entry_hash(feed.latest_id))
+        return seen
+
+    def parse_feed(self, feed, seen=None, from_cache=False, max_age=None,
+                   deadline=None):
+        # Only network and parsing here, this method is run by
+        # fetch_feeds workers and must never touch the database.
+        # The parsed document is dropped for a ParsedFeed right away
+        from .entry import ParsedFeed
+        from .feed import entry_hash
+        from .fetcher import fetch, fetch_cached
+
+        cache = self.cache
+        if from_cache:
+            if cache is None:
+                self.logger.warning('[feed-%s] no cache dir set, fetching' % feed.id)
             else:
-                # i is default to 0 in case feed has never been fetched
-                # i will be entries element index to start to send email
-                i = 0
-                if feed.latest_id:
-                    for i, e in enumerate(d.entries):
-                        entry_id = e.get('id', e.get('link'))
-                        if entry_id == feed.latest_id:
-                            break
-
-                    if not i:
-                        self.logger.info('[feed-%s] no updates found' % feed.id)
-                        return
-
-                # Reverse list to have oldest entry in first
-                d.entries.reverse()
-                self.logger.info('[feed-%s] %s updates found' % (
-                    feed.id, len(d.entries[-i:])))
-                for e in d.entries[-i:]:
-                    entry_id = e.get('id', e.get('link'))
-                    self.logger.debug('[feed-%s] %s (%s)' % (
-                        feed.id, e.title, entry_id))
-                    r = self.send_email(feed, d, e)
-                    if r:
+                d = fetch_cached(cache, feed.url, max_age=max_age,
+                                 metrics=self.metrics.feed(feed.id))
+                if d is not None:
+                    return ParsedFeed.from_parsed(d)
+                self.logger.info('[feed-%s] not in cache, fetching' % feed.id)
+
+        stop = None
+        # Only complete documents are cached, so don't stop early, nor
+        # on feeds which may add their new entries anywhere but on top
+        if seen and cache is None and feed.newest_first and \
+                self.config.getboolean('fetch', 'stream'):
+            stop = lambda entry_id: entry_hash(entry_id) in seen
+        return ParsedFeed.from_parsed(fetch(
+            feed.url, etag=feed.etag, modified=feed.modified,
+            metrics=self.metrics.feed(feed.id),
+            timeout=self.config.getint('fetch', 'timeout'),
+            connect_timeout=self.config.getint('fetch', 'connect_timeout'),
+            deadline=deadline,
+            max_size=self.config.getint('fetch', 'max_size'),
+            stop=stop,
+            stop_after=self.config.getint('fetch', 'stop_after'),
+            hosts=self.hosts,
+            digest=feed.digest,
+            cache=cache))
+
+    @bound
+    def process_feed(self, feed, d):
+        # Queued emails and feed state are committed together, so
+        # a delivery failure never makes a feed fetched twice
+        with self.atomic():
+            if self._lease_lost(feed):
+                return 0
+            return self._process_feed(feed, d)
+
+    def _process_feed(self, feed, d):
+        from .fetcher import DEFER_CODES
+
+        stats = self.metrics.feed(feed.id)
+        email_count = 0
+        batch = self.config.getboolean('email', 'batch')
+        headers = d.get('headers', {})
+        retry_after = parse_retry_after(headers.get('retry-after'))
+        if d.get('status') == 304 or d.get('unchanged'):
+            self.logger.info('[feed-%s] not modified' % feed.id)
+            if d.get('unchanged'):
+                feed.etag = d.get('etag')
+                feed.modified = d.get('modified')
+            self._feed_succeeded(feed, d, 'not_modified')
+            self.scheduler.reschedule(feed, retry_after=retry_after)
+            feed.save()
+            return email_count
+        if d.get('status') in DEFER_CODES:
+            # Not an error of the feed, polled again once the server
+            # is available, at the usual interval without Retry-After
+            self.feed_deferred(
+                feed, retry_after or feed.interval or self.scheduler.default_interval,
+                'HTTP %s' % d.get('status'))
+            return email_count
+        if d.get('status', 200) >= 400 or (d.get('bozo') and not d.entries):
+            self.feed_failed(feed, d.get('bozo_exception') or
+                             'HTTP %s' % d.get('status'), retry_after,
+                             http_status=d.get('status'))
+            return email_count
+        if d.get('bozo'):
+            self.logger.warning('[feed-%s] not well formed (%s)' % (
+                feed.id, d.get('bozo_exception')))
+        self._feed_succeeded(feed, d, 'malformed' if d.get('bozo') else 'ok')
+
+        feed.etag = d.get('etag')
+        feed.modified = d.get('modified')
+        # A truncated document only tells about the entries read, which
+        # are all the new ones for feeds listed newest first only
+        partial = d.get('truncated') and not feed.newest_first
+        if not partial:
+            feed.digest = d.get('digest')
+        updated = d.feed.get('updated_parsed') or d.feed.get('published_parsed')
+        if updated is None:
+            updated = datetime.now()
+        else:
+            updated = datetime.fromtimestamp(mktime(updated))
+
+        new_count = 0
+        if feed.updated is not None and updated <= feed.updated:
+            self.logger.info('[feed-%s] no updates found' % feed.id)
+        else:
+            with stats.timer('process'):
+                entries = self.new_entries(feed, d.entries)
+                if not d.get('truncated'):
+                    newest_first = self._newest_first(d.entries, entries)
+                    if newest_first is not None:
+                        feed.newest_first = newest_first
+            # Only new entries are kept from now on
+            d.entries = entries
+            stats.incr('new_entries', len(entries))
+            # Reverse list to have oldest entry in first
+            entries.reverse()
+            self.logger.info('[feed-%s] %s updates found' % (
+                feed.id, len(entries)))
+            for e in entries:
+                self.logger.debug('[feed-%s] %s (%s)' % (
+                    feed.id, e.title, e.get('id', e.get('link'))))
+                if not batch:
+                    if self.send_email(feed, d, e):
                         email_count += 1
-                feed.latest_id = entry_id
+            if batch and entries:
+                if self.send_digest(feed, d, entries):
+                    email_count += 1
+            if entries:
+                feed.latest_id = entries[-1].get('id', entries[-1].get('link'))
+            new_count = len(entries)
 
-            self.logger.info('[feed-%s] %s email(s) sent' % (feed.id, email_count))
+        self.logger.info('[feed-%s] %s email(s) queued' % (feed.id, email_count))
+        if not partial:
             feed.updated = updated
+        self.scheduler.reschedule(
+            feed, new_count, ttl=self._get_ttl(d), retry_after=retry_after)
+        with stats.timer('process'):
+            feed.save()
+        return email_count
+
+    def _newest_first(self, entries, new):
+        """
+        Whether entries of a complete document are listed newest first,
+        from their dates or from where the new ones are. None if the
+        document doesn't tell.
+        """
+        dates = [e.get('published_parsed') or e.get('updated_parsed')
+                 for e in entries]
+        if len(dates) > 1 and all(dates):
+            return all(a >= b for a, b in zip(dates, dates[1:]))
+        if 0 < len(new) < len(entries):
+            new_ids = set(id(e) for e in new)
+            return all(id(e) in new_ids for e in entries[:len(new)])
+        return None
+
+    def _get_ttl(self, d):
+        try:
+            return int(d.feed.get('ttl'))
+        except (TypeError, ValueError):
+            return None
+
+    def _feed_succeeded(self, feed, d, status):
+        feed.last_status = status
+        feed.last_http_status = d.get('status')
+        feed.last_success = datetime.now()
+        feed.last_error = str(d.get('bozo_exception')) if d.get('bozo') else None
+        if feed.disabled:
+            self.logger.info('[feed-%s] enabled again' % feed.id)
+            feed.disabled = False
+
+    @bound
+    def feed_failed(self, feed, error, retry_after=None, http_status=None):
+        self.logger.error('[feed-%s] fetch failed (%s)' % (feed.id, error))
+        self.metrics.feed(feed.id).incr('errors')
+        with self.atomic():
+            if self._lease_lost(feed):
+                return
+            self.scheduler.reschedule(feed, error=True, retry_after=retry_after)
+            feed.last_status = 'error'
+            feed.last_http_status = http_status
+            feed.last_error = str(error)
+            # Dead feeds aren't fetched anymore, until reset or
+            # fetched successfully by hand
+            max_errors = self.config.getint('fetch', 'max_errors')
+            if max_errors and feed.errors >= max_errors and not feed.disabled:
+                self.logger.warning('[feed-%s] disabled after %s errors in a row' % (
+                    feed.id, feed.errors))
+                feed.disabled = True
             feed.save()
+
+    def run_lock(self):
+        """RunLock of [settings] lock_file, None if not set."""
+        path = self.config.get('settings', 'lock_file')
+        if path:
+            from .lock import RunLock
+            return RunLock(path)
+
+    @bound
+    def feed_deferred(self, feed, retry_after=None, reason='deadline reached'):
+        """
+        Postpone feed without counting an error, to retry_after seconds
+        from now if given, otherwise to the next run.
+        """
+        self.logger.warning('[feed-%s] %s, deferred' % (feed.id, reason))
+        self.metrics.feed(feed.id).incr('deferred')
+        with self.atomic():
+            if self._lease_lost(feed):
+                return
+            if retry_after:
+                feed.next_poll = datetime.now() + timedelta(seconds=retry_after)
+            elif feed.next_poll is None:
+                # Still due, first ones polled by the next run
+                feed.next_poll = datetime.now()
+            self.scheduler.push(feed)
+            feed.save()
+
+    @bound
+    def fetch_feed(self, feed_id=None, from_cache=False, max_age=None):
+        from .hosts import HostDeferred
+
+        feed = self.get_feed(feed_id=feed_id)
+
+        if feed is not None:
+            self.logger.info('[feed-%s] fetching feed (%s)' % (feed.id, feed.url))
+            try:
+                d = self.parse_feed(feed, self.seen_hashes(feed),
+                                    from_cache=from_cache, max_age=max_age)
+            except HostDeferred as e:
+                self.feed_deferred(feed, e.retry_after, str(e))
+                return 0
+            except Exception as e:
+                self.feed_failed(feed, e, getattr(e, 'retry_after', None))
+                return 0
+            email_count = self.process_feed(feed, d)
+            self.flush_outbox()
+            self.metrics.flush()
+            return email_count
         else:
             self.logger.info('[feed-%s] not exists' % feed_id)
+
+    @bound
+    def fetch_feeds(self, feeds=None, workers=None, deadline=None):
+        """
+        Fetch feeds, or every feed, and return the number of emails
+        queued. Feeds not fetched deadline seconds after the start of
+        the run ([settings] deadline, 0 for none) are deferred.
+        """
+        if workers is None:
+            workers = self.config.getint('settings', 'workers')
+        if deadline is None:
+            deadline = self.config.getfloat('settings', 'deadline')
+        deadline = time() + deadline if deadline else None
+
+        if feeds is not None:
+            email_count = self._fetch_feeds(feeds, workers, deadline)
+        else:
+            # Feeds are leased by batches, so runners sharing the
+            # database split the work and fetch each feed once per run
+            from .feed import Feed
+            started = datetime.now()
+            claim_size = self.config.getint('cluster', 'claim_size')
+
+            def claim():
+                # Failing feeds wait for their backoff delay
+                return self.claim_feeds(
+                    claim_size,
+                    Feed.last_polled.is_null() | (Feed.last_polled < started),
+                    Feed.disabled == False,
+                    (Feed.errors == 0) | Feed.next_poll.is_null() |
+                    (Feed.next_poll <= started))
+            email_count = self._fetch_feeds([], workers, deadline, claim)
+        self.flush_outbox(deadline)
+        self.metrics.flush()
+        return email_count
+
+    def _fetch_feeds(self, feeds, workers, deadline=None, claim=None):
+        """
+        Fetch feeds on a pool of workers, then the batches returned by
+        claim, claimed as workers free up until it returns none.
+        """
+        # Downloads and parsing are spread over workers while every
+        # database write and email is done here, in the calling thread,
+        # which owns the database connection
+        from .hosts import HostDeferred
+        from .fetcher import DeadlineExceeded
+
+        workers = max(1, workers)
+        pending = deque(feeds)
+        futures = {}
+        email_count = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                # A few feeds are queued ahead, workers are kept busy
+                # while results are processed here
+                while len(futures) < workers * 2:
+                    if not pending and claim is not None:
+                        if deadline is not None and time() >= deadline:
+                            self.logger.warning(
+                                '[info] deadline reached, remaining feeds deferred')
+                            claim = None
+                        else:
+                            pending.extend(claim() or ())
+                            if not pending:
+                                claim = None
+                    if not pending:
+                        break
+                    feed = pending.popleft()
+                    self.logger.info('[feed-%s] fetching feed (%s)' % (feed.id, feed.url))
+                    futures[executor.submit(
+                        self.parse_feed, feed, self.seen_hashes(feed),
+                        deadline=deadline)] = feed
+                if not futures:
+                    break
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    feed = futures.pop(future)
+                    try:
+                        d = future.result()
+                    except DeadlineExceeded:
+                        self.feed_deferred(feed)
+                        continue
+                    except HostDeferred as e:
+                        self.feed_deferred(feed, e.retry_after, str(e))
+                        continue
+                    except Exception as e:
+                        self.feed_failed(feed, e, getattr(e, 'retry_after', None))
+                        continue
+                    email_count += self.process_feed(feed, d)
+        return email_count
+
+    @bound
+    def run_pending(self):
+        """
+        Fetch feeds whose next poll time is reached and return the
+        number of seconds until the next one is due.
+        """
+        from .feed import Feed
+
+        now = datetime.now()
+        if self._scheduler_loaded is None or (now - self._scheduler_loaded) > \
+                timedelta(seconds=self.config.getint('daemon', 'refresh')):
+            # Pick up feeds added or removed by other processes
+            self.scheduler.load(self.sharded(Feed.select(
+                Feed.id, Feed.next_poll).where(Feed.disabled == False)), now)
+            self._scheduler_loaded = now
+
+        due = self.scheduler.pop_due(now)
+        if due:
+            self.logger.info('[daemon] %s feed(s) due' % len(due))
+            # Feeds already polled by another runner are not due anymore
+            feeds = []
+            for chunk in chunked(due, 500):
+                feeds.extend(self.claim_feeds(
+                    len(chunk), Feed.id.in_(chunk), Feed.disabled == False,
+                    Feed.next_poll.is_null() | (Feed.next_poll <= now)))
+            self.fetch_feeds(feeds)
+
+        next_due = self.scheduler.next_due()
+        if next_due is None:
+            return self.config.getint('daemon', 'refresh')
+        return max(1, (next_due - datetime.now()).total_seconds())
+
+    def run_daemon(self):
+        self.logger.info('[daemon] started')
+        while True:
+            delay = min(self.run_pending(),
+                        self.config.getint('daemon', 'refresh'))
+            self.logger.debug('[daemon] sleeping %ss' % int(delay))
+            sleep(delay)
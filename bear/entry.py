@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Compact records of a parsed feed, built by fetch workers so that the
+FeedParserDict document isn't kept around while feeds are processed.
+"""
+
+# Parsed fields kept in slots, under their name or an alias
+SLOTTED = ('id', 'title', 'link', 'summary', 'description', 'published')
+
+
+class Entry:
+    """
+    Fields of an entry used by Bear, other parsed fields (content,
+    tags, title_detail...) are kept in a plain dict and read on access.
+    """
+    __slots__ = ('id', 'title', 'link', 'description', 'published', '_data')
+
+    ALIASES = {'summary': 'description', 'guid': 'id'}
+
+    def __init__(self, id=None, title='', link='', description='',
+                 published=None, data=None):
+        self.id = id
+        self.title = title
+        self.link = link
+        self.description = description
+        self.published = published
+        self._data = data if data is not None else {}
+
+    @classmethod
+    def from_parsed(cls, entry):
+        """Copy the fields of a feedparser entry to an Entry."""
+        data = dict(
+            (key, value) for key, value in entry.items()
+            if key not in SLOTTED)
+        return cls(
+            id=entry.get('id'),
+            title=entry.get('title', ''),
+            link=entry.get('link', ''),
+            description=entry.get('description', ''),
+            published=entry.get('published'),
+            data=data)
+
+    def __getattr__(self, name):
+        # Only called for names which aren't slots
+        if name.startswith('__') or name == '_data':
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        key = self.ALIASES.get(key, key)
+        if key in self.__slots__:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        key = self.ALIASES.get(key, key)
+        if key in self.__slots__:
+            setattr(self, key, value)
+        else:
+            self._data[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return '<Entry %s>' % (self.id or self.link)
+
+
+class ParsedFeed:
+    """Response and feed header of a parsed document, with its Entry list."""
+    __slots__ = (
+        'status', 'headers', 'href', 'etag', 'modified', 'digest', 'bozo',
+        'bozo_exception', 'unchanged', 'truncated', 'cached', 'version',
+        'encoding', 'namespaces', 'feed', 'entries')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+        if self.entries is None:
+            self.entries = []
+
+    @classmethod
+    def from_parsed(cls, d):
+        kwargs = dict((name, d.get(name)) for name in cls.__slots__)
+        kwargs['bozo'] = bool(d.get('bozo'))
+        kwargs['entries'] = [Entry.from_parsed(e) for e in d.get('entries', ())]
+        return cls(**kwargs)
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
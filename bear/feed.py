@@ -1,17 +1,118 @@
 # -*- coding: utf-8 -*-
+import threading
+from hashlib import sha1
+from contextlib import contextmanager
 from datetime import datetime
 from peewee import Model
 from peewee import CharField
+from peewee import TextField
+from peewee import IntegerField
+from peewee import BooleanField
 from peewee import DateTimeField
+from peewee import DatabaseProxy
+from peewee import ForeignKeyField
 
-from .core import DB
+class ThreadDatabase(DatabaseProxy):
+    """
+    Database of the models: the one bound in the current thread by the
+    running Bear instance (see bind), the initialized default otherwise.
+    Instances running in different threads never see each other's.
+    """
+    __slots__ = ('default', 'local')
 
+    def __init__(self):
+        self.local = threading.local()
+        super().__init__()
 
-class Feed(Model):
+    def __setattr__(self, attr, value):
+        # Slots of every proxy class, unknown attributes still fail
+        object.__setattr__(self, attr, value)
+
+    def _get_obj(self):
+        db = getattr(self.local, 'db', None)
+        return self.default if db is None else db
+
+    def _set_obj(self, obj):
+        self.default = obj
+
+    obj = property(_get_obj, _set_obj)
+
+    @contextmanager
+    def bind(self, db):
+        previous = getattr(self.local, 'db', None)
+        self.local.db = db
+        try:
+            yield db
+        finally:
+            self.local.db = previous
+
+
+# Default database, each Bear instance binds models to its own one
+# while running (see Bear.initialize_db)
+database = ThreadDatabase()
+
+
+def entry_hash(entry_id):
+    if not isinstance(entry_id, bytes):
+        entry_id = (entry_id or '').encode('utf-8')
+    return sha1(entry_id).hexdigest()
+
+
+class BaseModel(Model):
+    class Meta:
+        database = database
+
+
+class Feed(BaseModel):
     url = CharField(unique=True)
     added = DateTimeField(default=datetime.now)
     updated = DateTimeField(null=True)
     latest_id = CharField(null=True)
+    etag = CharField(null=True)
+    modified = CharField(null=True)
+    interval = IntegerField(null=True)
+    next_poll = DateTimeField(null=True, index=True)
+    changed = DateTimeField(null=True)
+    errors = IntegerField(default=0)
+    locked_by = CharField(null=True)
+    lease_until = DateTimeField(null=True)
+    last_polled = DateTimeField(null=True)
+    digest = CharField(max_length=40, null=True)
+    last_status = CharField(null=True)
+    last_http_status = IntegerField(null=True)
+    last_success = DateTimeField(null=True)
+    last_error = TextField(null=True)
+    disabled = BooleanField(default=False)
+    newest_first = BooleanField(null=True)
+
+
+class Outbox(BaseModel):
+    feed = ForeignKeyField(Feed, null=True, backref='outbox')
+    sender = CharField()
+    to = TextField()
+    message = TextField()
+    status = CharField(default='pending')
+    attempts = IntegerField(default=0)
+    created = DateTimeField(default=datetime.now)
+    next_attempt = DateTimeField(default=datetime.now)
+    last_error = TextField(null=True)
+    locked_by = CharField(null=True)
+
+    class Meta:
+        indexes = (
+            (('status', 'next_attempt'), False),
+        )
+
+
+class SeenEntry(BaseModel):
+    feed = ForeignKeyField(Feed, backref='seen_entries')
+    entry_hash = CharField(max_length=40)
+    seen = DateTimeField(default=datetime.now)
 
     class Meta:
-        database = DB
+        indexes = (
+            (('feed', 'entry_hash'), True),
+        )
+
+
+MODELS = [Feed, Outbox, SeenEntry]
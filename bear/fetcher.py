@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+Feed downloader with size cap and timeout, parsing the document while
+it is downloaded so that only the feed header and unseen entries are
+kept in memory before being handed to feedparser.
+"""
+import time
+import zlib
+import socket
+import logging
+import feedparser
+from hashlib import sha1
+from xml.etree import ElementTree
+
+try:
+    from urlparse import urlparse, urljoin
+    from httplib import HTTPException
+except ImportError:
+    from urllib.parse import urlparse, urljoin
+    from http.client import HTTPException
+
+from . import __version__
+from .hosts import Hosts
+from .scheduler import parse_retry_after
+
+logger = logging.getLogger('bear.fetcher')
+
+CHUNK_SIZE = 16384
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+# Server is busy, the feed is fetched again later
+DEFER_CODES = (429, 503)
+
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+RDF_NS = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+ENTRY_TAGS = (
+    'item',
+    ATOM_NS + 'entry',
+    '{http://purl.org/rss/1.0/}item')
+
+
+class FetchError(Exception):
+    pass
+
+
+class DeadlineExceeded(FetchError):
+    """Run deadline reached, the feed is left for the next run."""
+
+
+class LimitedReader:
+    """Decompress a response body on the fly and enforce max_size."""
+    def __init__(self, response, max_size, deadline=None):
+        self.response = response
+        self.max_size = max_size
+        self.deadline = deadline
+        self.size = 0
+        self.read_time = 0
+
+        encoding = response.headers.get('content-encoding', '').lower()
+        self.decompressor = None
+        if encoding == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+
+    def chunks(self):
+        while True:
+            start = time.time()
+            try:
+                raw = self.response.read(CHUNK_SIZE)
+            except socket.timeout:
+                if self.deadline is not None and time.time() >= self.deadline:
+                    raise DeadlineExceeded('deadline reached while downloading')
+                raise
+            self.read_time += time.time() - start
+            data = raw
+            if self.decompressor is not None:
+                if raw:
+                    data = self.decompressor.decompress(raw)
+                else:
+                    data = self.decompressor.flush()
+            self.size += len(data)
+            if self.max_size and self.size > self.max_size:
+                raise FetchError('feed larger than %s bytes' % self.max_size)
+            if self.deadline is not None and time.time() > self.deadline:
+                raise DeadlineExceeded('deadline reached while downloading')
+            if data:
+                yield data
+            if not raw:
+                return
+
+
+def entry_id(element):
+    """Entry id as feedparser would find it (id, guid or link)."""
+    # RSS 1.0 items are identified by their rdf:about attribute
+    about = element.get(RDF_NS + 'about')
+    if about and about.strip():
+        return about.strip()
+    for tag in ('guid', ATOM_NS + 'id', 'link', ATOM_NS + 'link',
+                '{http://purl.org/rss/1.0/}link'):
+        child = element.find(tag)
+        if child is None:
+            continue
+        value = child.get('href') if tag == ATOM_NS + 'link' else child.text
+        if value and value.strip():
+            return value.strip()
+    return None
+
+
+def stream_parse(chunks, stop, stop_after=1):
+    """
+    Build the feed document while reading it and stop once stop(entry_id)
+    is true for stop_after consecutive entries. Return the document as
+    bytes, whether it has been truncated and a digest of the ids of the
+    entries read. Raise ParseError for documents ElementTree can't handle.
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    stack = []
+    root = None
+    known = 0
+    digest = sha1()
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == 'start':
+                if root is None:
+                    root = element
+                stack.append(element)
+                continue
+            stack.pop()
+            if element.tag not in ENTRY_TAGS:
+                continue
+            _id = entry_id(element)
+            digest.update((_id or '').encode('utf-8') + b'\n')
+            known = known + 1 if stop(_id) else 0
+            if known >= stop_after:
+                # Enough known entries in a row, everything after them
+                # has already been seen, drop the last one and whatever
+                # the parser may already have built after it
+                parent = stack[-1]
+                del parent[list(parent).index(element):]
+                for ancestor, child in zip(stack, stack[1:]):
+                    del ancestor[list(ancestor).index(child) + 1:]
+                return (ElementTree.tostring(root, encoding='utf-8'), True,
+                        digest.hexdigest())
+    parser.close()
+    return (ElementTree.tostring(root, encoding='utf-8'), False,
+            digest.hexdigest())
+
+
+def timed_connection(metrics):
+    """socket.create_connection recording name resolution in metrics."""
+    def create_connection(address, timeout, source_address=None):
+        host, port = address
+        with metrics.timer('dns'):
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        for i, info in enumerate(infos):
+            try:
+                return socket.create_connection(
+                    info[4][:2], timeout, source_address)
+            except socket.error:
+                if i == len(infos) - 1:
+                    raise
+        raise socket.error('no address for %s' % host)
+    return create_connection
+
+
+def send(conn, path, headers, timeout, connect_timeout, metrics=None):
+    if conn.sock is None:
+        conn.timeout = connect_timeout
+        if metrics is not None:
+            conn._create_connection = timed_connection(metrics)
+        conn.connect()
+    # Read timeout, for each blocking socket operation
+    conn.sock.settimeout(timeout)
+    conn.request('GET', path, headers=headers)
+    return conn.getresponse()
+
+
+def request(hosts, url, headers, timeout, connect_timeout=None, metrics=None,
+            deadline=None):
+    """
+    GET url on a connection of hosts, following redirects. Return the
+    connection, the response, its final url and the host whose slot is
+    held, to be released by the caller once the body is read. Name
+    resolutions of new connections are recorded in metrics if given.
+    DeadlineExceeded is raised if no slot is free before the deadline.
+    """
+    if connect_timeout is None:
+        connect_timeout = timeout
+    held = None
+    try:
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlparse(url)
+            if parts.scheme not in ('http', 'https') or not parts.hostname:
+                raise FetchError('unsupported url %s' % url)
+            if parts.hostname != held:
+                if held is not None:
+                    hosts.release(held)
+                    held = None
+                if not hosts.acquire(parts.hostname, deadline):
+                    raise DeadlineExceeded(
+                        'deadline reached waiting for %s' % parts.hostname)
+                held = parts.hostname
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            conn, reused = hosts.connection(
+                parts.scheme, parts.hostname, parts.port, timeout)
+            try:
+                response = send(
+                    conn, path, headers, timeout, connect_timeout, metrics)
+            except socket.timeout:
+                conn.close()
+                raise
+            except (HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                # Kept-alive connection closed by the server meanwhile
+                conn, _ = hosts.connection(
+                    parts.scheme, parts.hostname, parts.port, timeout,
+                    reuse=False)
+                try:
+                    response = send(
+                        conn, path, headers, timeout, connect_timeout, metrics)
+                except Exception:
+                    conn.close()
+                    raise
+
+            location = response.getheader('location')
+            if response.status not in REDIRECT_CODES or not location:
+                return conn, response, url, held
+            response.read()
+            hosts.keep(conn, response)
+            url = urljoin(url, location)
+        raise FetchError('too many redirects')
+    except Exception:
+        if held is not None:
+            hosts.release(held)
+        raise
+
+
+def parse(url, headers, body, serialized=False):
+    """Parse body like feedparser.parse would with response headers."""
+    response_headers = dict(headers)
+    response_headers['content-location'] = url
+    response_headers.pop('content-encoding', None)
+    if serialized:
+        # Body has been serialized again in utf-8
+        response_headers['content-type'] = 'application/xml; charset=utf-8'
+    return feedparser.parse(body, response_headers=response_headers)
+
+
+def fetch_cached(cache, url, max_age=None, metrics=None):
+    """Parse the cached response of url, None if not in cache."""
+    cached = cache.get(url, max_age)
+    if cached is None:
+        return None
+    headers, body, age = cached
+    logger.debug('[fetch] %s from cache (%ss old)' % (url, int(age)))
+    d = parse(url, headers, body)
+    if metrics is not None:
+        metrics.incr('cached')
+        metrics.incr('entries', len(d.entries))
+    d['status'] = 200
+    d['headers'] = headers
+    d['href'] = url
+    d['truncated'] = False
+    d['digest'] = sha1(body).hexdigest()
+    d['cached'] = age
+    if headers.get('etag'):
+        d['etag'] = headers['etag']
+    if headers.get('last-modified'):
+        d['modified'] = headers['last-modified']
+    return d
+
+
+def fetch(url, etag=None, modified=None, timeout=30, max_size=None,
+          stop=None, stop_after=1, metrics=None, hosts=None, digest=None,
+          cache=None, connect_timeout=None, deadline=None):
+    """
+    Download and parse url, returning a FeedParserDict like
+    feedparser.parse does with status, headers, etag, modified and
+    digest. The body isn't parsed when its digest is the given one,
+    unchanged is then set and there are no entries.
+    Requests go through hosts (see Hosts) for politeness and kept-alive
+    connections. Complete documents are stored in cache (see
+    ResponseCache) if given. Stage durations and counters are recorded
+    in metrics if given.
+    Socket operations time out after timeout seconds (connect_timeout
+    to connect), DeadlineExceeded is raised past the deadline timestamp.
+    """
+    if hosts is None:
+        # Connections of a lone fetch aren't kept
+        hosts = Hosts(delay=0)
+        try:
+            return fetch(
+                url, etag=etag, modified=modified, timeout=timeout,
+                max_size=max_size, stop=stop, stop_after=stop_after,
+                metrics=metrics, hosts=hosts, digest=digest, cache=cache,
+                connect_timeout=connect_timeout, deadline=deadline)
+        finally:
+            hosts.close()
+
+    requested = url
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded('deadline reached')
+        timeout = min(timeout, remaining)
+        connect_timeout = min(connect_timeout or timeout, remaining)
+    headers = {
+        'User-Agent': 'bear/%s' % __version__,
+        'Accept-Encoding': 'gzip, deflate'}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    start = time.time()
+    try:
+        conn, response, url, host = request(
+            hosts, url, headers, timeout, connect_timeout, metrics, deadline)
+    except socket.timeout:
+        if deadline is not None and time.time() >= deadline:
+            raise DeadlineExceeded('deadline reached while connecting')
+        raise
+    try:
+        headers = dict((k.lower(), v) for k, v in response.getheaders())
+        if not 200 <= response.status < 300:
+            if metrics is not None:
+                metrics.observe('connect', time.time() - start)
+                if response.status == 304:
+                    metrics.incr('not_modified')
+                elif response.status not in DEFER_CODES:
+                    metrics.incr('errors')
+            if response.status in DEFER_CODES:
+                retry_after = parse_retry_after(headers.get('retry-after'))
+                if retry_after:
+                    hosts.defer(host, retry_after)
+            response.read(CHUNK_SIZE)
+            hosts.keep(conn, response)
+            return feedparser.FeedParserDict(
+                status=response.status, headers=headers, href=url,
+                feed=feedparser.FeedParserDict(), entries=[],
+                bozo=response.status != 304)
+
+        connected = time.time()
+        reader = LimitedReader(response, max_size, deadline)
+        truncated = False
+        body = None
+        try:
+            if stop is not None:
+                consumed = []
+
+                def chunks():
+                    for chunk in reader.chunks():
+                        consumed.append(chunk)
+                        yield chunk
+                try:
+                    body, truncated, body_digest = stream_parse(
+                        chunks(), stop, stop_after)
+                except ElementTree.ParseError as e:
+                    # Let feedparser loose parser handle broken documents
+                    logger.debug('[fetch] %s not well formed, full parse (%s)' % (url, e))
+                    consumed.extend(reader.chunks())
+                    body = b''.join(consumed)
+                    stop = None
+                raw = body if truncated else b''.join(consumed)
+            if stop is None:
+                if body is None:
+                    body = b''.join(reader.chunks())
+                raw = body
+                body_digest = sha1(body).hexdigest()
+        finally:
+            # Connections of truncated downloads can't be reused
+            hosts.keep(conn, response)
+    finally:
+        hosts.release(host)
+
+    if cache is not None and not truncated:
+        cache_headers = dict(headers)
+        for name in ('content-encoding', 'content-length', 'transfer-encoding'):
+            cache_headers.pop(name, None)
+        cache.put(requested, cache_headers, raw)
+
+    if metrics is not None:
+        metrics.observe('connect', connected - start)
+        metrics.observe('download', reader.read_time)
+        metrics.incr('bytes', reader.size)
+    if digest is not None and body_digest == digest:
+        # Same document as last time, nothing to parse
+        d = feedparser.FeedParserDict(
+            feed=feedparser.FeedParserDict(), entries=[], bozo=False,
+            unchanged=True)
+        if metrics is not None:
+            metrics.incr('unchanged')
+    else:
+        d = parse(url, headers, body, serialized=stop is not None)
+        if metrics is not None:
+            metrics.observe('parse', time.time() - connected - reader.read_time)
+            metrics.incr('entries', len(d.entries))
+    d['status'] = response.status
+    d['headers'] = headers
+    d['href'] = url
+    d['truncated'] = truncated
+    d['digest'] = body_digest
+    if headers.get('etag'):
+        d['etag'] = headers['etag']
+    if headers.get('last-modified'):
+        d['modified'] = headers['last-modified']
+    return d
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Per host politeness: a limited number of concurrent requests to each
+host, a minimum delay between two of them, and kept-alive connections
+shared by feeds of the same host.
+"""
+import time
+import logging
+import threading
+
+try:
+    from httplib import HTTPConnection, HTTPSConnection
+except ImportError:
+    from http.client import HTTPConnection, HTTPSConnection
+
+logger = logging.getLogger('bear.hosts')
+
+
+class HostDeferred(Exception):
+    """Host won't accept a request before retry_after seconds."""
+    def __init__(self, host, retry_after):
+        super().__init__('%s deferred for %ss' % (host, int(retry_after)))
+        self.retry_after = retry_after
+
+
+class Host:
+    def __init__(self, max_connections):
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.next_slot = 0
+        self.idle = {}
+
+
+class Hosts:
+    def __init__(self, max_connections=2, delay=1, max_wait=30):
+        self.max_connections = max(1, max_connections)
+        self.delay = delay
+        self.max_wait = max_wait
+        self.hosts = {}
+        self._lock = threading.Lock()
+        self._ssl_context = None
+
+    def get(self, name):
+        with self._lock:
+            host = self.hosts.get(name)
+            if host is None:
+                host = self.hosts[name] = Host(self.max_connections)
+            return host
+
+    def acquire(self, name, deadline=None):
+        """
+        Wait for a free connection slot and for the delay since the
+        previous request to name. Raise HostDeferred if that would take
+        more than max_wait seconds, return False without holding a slot
+        if it can't be done before the deadline timestamp.
+        """
+        host = self.get(name)
+        if deadline is None:
+            host.semaphore.acquire()
+        elif not host.semaphore.acquire(timeout=max(0, deadline - time.time())):
+            return False
+        with self._lock:
+            now = time.time()
+            wait = host.next_slot - now
+            if wait > self.max_wait:
+                host.semaphore.release()
+                raise HostDeferred(name, wait)
+            if deadline is not None and now + max(0, wait) >= deadline:
+                host.semaphore.release()
+                return False
+            host.next_slot = max(now, host.next_slot) + self.delay
+        if wait > 0:
+            logger.debug('[hosts] waiting %.2fs for %s' % (wait, name))
+            time.sleep(wait)
+        return True
+
+    def release(self, name):
+        self.get(name).semaphore.release()
+
+    def defer(self, name, seconds):
+        """Don't send requests to name for the next seconds."""
+        host = self.get(name)
+        with self._lock:
+            host.next_slot = max(host.next_slot, time.time() + seconds)
+        logger.info('[hosts] %s deferred for %ss' % (name, seconds))
+
+    def connection(self, scheme, name, port, timeout, reuse=True):
+        """Return a (connection, reused) tuple for scheme://name:port."""
+        key = (scheme, name, port)
+        host = self.get(name)
+        with self._lock:
+            idle = host.idle.get(key)
+            if idle and reuse:
+                return idle.pop(), True
+
+        if scheme == 'https':
+            if self._ssl_context is None:
+                import ssl
+                self._ssl_context = ssl.create_default_context()
+            conn = HTTPSConnection(
+                name, port, timeout=timeout, context=self._ssl_context)
+        else:
+            conn = HTTPConnection(name, port, timeout=timeout)
+        conn.bear_key = key
+        return conn, False
+
+    def keep(self, conn, response):
+        """Keep conn for the next request if response has been fully read."""
+        if response.will_close or not response.isclosed():
+            conn.close()
+            return
+        host = self.get(conn.bear_key[1])
+        with self._lock:
+            idle = host.idle.setdefault(conn.bear_key, [])
+            if len(idle) < self.max_connections:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            for host in self.hosts.values():
+                for idle in host.idle.values():
+                    for conn in idle:
+                        conn.close()
+                host.idle = {}
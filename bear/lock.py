@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Lock file held for the duration of a run, so that a run started by cron
+while the previous one is still going exits instead of piling up.
+"""
+import os
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('bear.lock')
+
+
+class RunLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        """Return False if another process holds the lock."""
+        if fcntl is None:
+            logger.warning('[lock] file locks not supported, %s ignored' % self.path)
+            return True
+        f = open(self.path, 'a+')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            f.close()
+            return False
+        # Pid of the holder, for whoever finds the run stuck
+        f.seek(0)
+        f.truncate()
+        f.write('%s\n' % os.getpid())
+        f.flush()
+        self._file = f
+        return True
+
+    def release(self):
+        # Lock is released when the file is closed, the file is kept
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+import smtplib
+import threading
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+logger = logging.getLogger('bear.mailer')
+
+
+class Mailer:
+    """
+    Deliver queued messages through a small pool of reusable SMTP
+    connections, each one owned by a worker thread.
+    """
+    def __init__(self, host='localhost', port=25, tls=False, user=None,
+                 password=None, pool_size=2, max_per_connection=100,
+                 timeout=30):
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.user = user
+        self.password = password
+        self.pool_size = max(1, pool_size)
+        self.max_per_connection = max_per_connection
+        self.timeout = timeout
+
+        self.queue = Queue()
+        self.results = []
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def connect(self):
+        conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.ehlo()
+            if self.tls:
+                conn.starttls()
+                conn.ehlo()
+            if self.user:
+                conn.login(self.user, self.password)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def start(self):
+        while len(self._workers) < self.pool_size:
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def send(self, sender, to, message, message_id=None):
+        self.start()
+        self.queue.put((message_id, sender, to, message))
+
+    def flush(self, deadline=None):
+        """
+        Wait for queued messages and return their
+        (message_id, error, seconds) results. Messages still queued at
+        the deadline timestamp are dropped, seconds is None for them,
+        those being sent are left out.
+        """
+        skipped = []
+        if deadline is None:
+            self.queue.join()
+        else:
+            with self.queue.all_tasks_done:
+                while self.queue.unfinished_tasks:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.queue.all_tasks_done.wait(remaining)
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    break
+                self.queue.task_done()
+                skipped.append((item[0], None, None))
+            if skipped:
+                logger.warning('[mailer] deadline reached, %s message(s) not sent' % (
+                    len(skipped)))
+        with self._lock:
+            results, self.results = self.results, []
+        return results + skipped
+
+    def close(self):
+        for _ in self._workers:
+            self.queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def _quit(self, conn):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, IOError):
+            conn.close()
+
+    def _deliver(self, conn, sender, to, message):
+        try:
+            conn.sendmail(sender, to, message)
+        except smtplib.SMTPServerDisconnected:
+            # Server may drop idle connections, open a new one and
+            # retry once before giving up on this message
+            logger.debug('[mailer] connection lost, reconnecting')
+            conn.close()
+            conn = self.connect()
+            try:
+                conn.sendmail(sender, to, message)
+            except Exception:
+                conn.close()
+                raise
+        return conn
+
+    def _work(self):
+        conn = None
+        sent = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                if conn is not None:
+                    self._quit(conn)
+                self.queue.task_done()
+                return
+
+            message_id, sender, to, message = item
+            error = None
+            start = time.time()
+            try:
+                if conn is not None and sent >= self.max_per_connection:
+                    self._quit(conn)
+                    conn = None
+                if conn is None:
+                    conn = self.connect()
+                    sent = 0
+                conn = self._deliver(conn, sender, to, message)
+                sent += 1
+            except Exception as e:
+                # Whatever happens the worker must live on, flush()
+                # waits for every queued message
+                logger.error('[mailer] sending to %s failed (%s)' % (
+                    ', '.join(to), e))
+                error = e
+                if conn is not None:
+                    try:
+                        conn.rset()
+                    except Exception:
+                        conn.close()
+                        conn = None
+            finally:
+                with self._lock:
+                    self.results.append((message_id, error, time.time() - start))
+                self.queue.task_done()
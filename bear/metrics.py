@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+STAGES = (
+    'dns', 'connect', 'download', 'parse', 'process',
+    'plugins', 'render', 'smtp')
+COUNTERS = (
+    'bytes', 'entries', 'new_entries', 'emails', 'sent',
+    'errors', 'not_modified', 'cached', 'deferred')
+
+
+class FeedMetrics:
+    """Metrics recorder bound to one feed, safe to use from workers."""
+    def __init__(self, metrics, feed_id):
+        self.metrics = metrics
+        self.feed_id = feed_id
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - start)
+
+    def observe(self, stage, seconds):
+        self.metrics.observe(self.feed_id, stage, seconds)
+
+    def incr(self, counter, value=1):
+        self.metrics.incr(self.feed_id, counter, value)
+
+
+class Metrics:
+    """
+    Collect per feed stage durations and counters during a run, then
+    write them as JSON lines and optionally as a Prometheus textfile.
+    """
+    def __init__(self, path=None, prometheus_path=None):
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+
+    def feed(self, feed_id):
+        return FeedMetrics(self, feed_id)
+
+    def observe(self, feed_id, stage, seconds):
+        with self._lock:
+            stages = self.stages.setdefault(feed_id, {})
+            stages[stage] = stages.get(stage, 0) + seconds
+
+    def incr(self, feed_id, counter, value=1):
+        with self._lock:
+            counters = self.counters.setdefault(feed_id, {})
+            counters[counter] = counters.get(counter, 0) + value
+
+    def flush(self):
+        with self._lock:
+            stages, counters = self.stages, self.counters
+            started = self.started
+            self.reset()
+        if not stages and not counters:
+            return
+
+        if self.path:
+            with open(self.path, 'a') as f:
+                for feed_id in sorted(set(stages) | set(counters), key=str):
+                    f.write(json.dumps({
+                        'time': int(started),
+                        'feed': feed_id,
+                        'stages': dict(
+                            (k, round(v, 6)) for k, v in stages.get(feed_id, {}).items()),
+                        'counters': counters.get(feed_id, {})},
+                        sort_keys=True) + '\n')
+        if self.prometheus_path:
+            self.write_prometheus(started, stages, counters)
+
+    def write_prometheus(self, started, stages, counters):
+        stage_totals = {}
+        for feed_stages in stages.values():
+            for stage, seconds in feed_stages.items():
+                stage_totals[stage] = stage_totals.get(stage, 0) + seconds
+        counter_totals = {}
+        for feed_counters in counters.values():
+            for counter, value in feed_counters.items():
+                counter_totals[counter] = counter_totals.get(counter, 0) + value
+
+        lines = [
+            '# HELP bear_run_timestamp_seconds Start time of the last run.',
+            '# TYPE bear_run_timestamp_seconds gauge',
+            'bear_run_timestamp_seconds %d' % started,
+            '# HELP bear_run_duration_seconds Duration of the last run.',
+            '# TYPE bear_run_duration_seconds gauge',
+            'bear_run_duration_seconds %f' % (time.time() - started),
+            '# HELP bear_run_feeds Feeds handled during the last run.',
+            '# TYPE bear_run_feeds gauge',
+            'bear_run_feeds %d' % len([f for f in stages if f is not None]),
+            '# HELP bear_stage_seconds Time spent per stage during the last run.',
+            '# TYPE bear_stage_seconds gauge']
+        for stage in sorted(stage_totals):
+            lines.append('bear_stage_seconds{stage="%s"} %f' % (
+                stage, stage_totals[stage]))
+        lines.extend([
+            '# HELP bear_events Events counted during the last run.',
+            '# TYPE bear_events gauge'])
+        for counter in sorted(counter_totals):
+            lines.append('bear_events{event="%s"} %d' % (
+                counter, counter_totals[counter]))
+
+        # Textfile collectors may read at any time, replace atomically
+        tmp_path = '%s.%s.tmp' % (self.prometheus_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, self.prometheus_path)
+
+
+def summarize(path, limit=10):
+    """Aggregate a JSON lines metrics file into slowest feeds and stages."""
+    feeds = {}
+    stages = {}
+    counters = {}
+    runs = set()
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            runs.add(record.get('time'))
+            feed_id = record.get('feed')
+            total = 0
+            for stage, seconds in record.get('stages', {}).items():
+                total += seconds
+                s = stages.setdefault(stage, {'total': 0, 'count': 0, 'max': 0})
+                s['total'] += seconds
+                s['count'] += 1
+                s['max'] = max(s['max'], seconds)
+            for counter, value in record.get('counters', {}).items():
+                counters[counter] = counters.get(counter, 0) + value
+            if feed_id is not None:
+                feed = feeds.setdefault(feed_id, {'total': 0, 'runs': 0, 'max': 0})
+                feed['total'] += total
+                feed['runs'] += 1
+                feed['max'] = max(feed['max'], total)
+
+    slowest = sorted(
+        feeds.items(), key=lambda f: f[1]['total'] / f[1]['runs'], reverse=True)
+    return {
+        'runs': len(runs),
+        'stages': stages,
+        'counters': counters,
+        'feeds': [(feed_id, dict(s, mean=s['total'] / s['runs']))
+                  for feed_id, s in slowest[:limit]]}
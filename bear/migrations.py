@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Versioned schema migrations. Each migration is applied once, in order,
+and recorded in the schemaversion table. Fresh databases are created
+from the models and marked as up to date.
+
+Migrations must not use models fields directly since models keep
+evolving: declare the columns they add as they were at that time.
+"""
+import logging
+from datetime import datetime
+from peewee import fn
+from peewee import Model
+from peewee import CharField
+from peewee import TextField
+from peewee import BooleanField
+from peewee import IntegerField
+from peewee import DateTimeField
+
+from .feed import database
+
+logger = logging.getLogger('bear.migrations')
+
+MIGRATIONS = []
+
+
+def migration(func):
+    MIGRATIONS.append(func)
+    return func
+
+
+class SchemaVersion(Model):
+    version = IntegerField(primary_key=True)
+    name = CharField()
+    applied = DateTimeField(default=datetime.now)
+
+    class Meta:
+        database = database
+
+
+def add_column(db, migrator, table, name, field):
+    from playhouse.migrate import migrate
+    # Tables created after this migration already have the column
+    if table in db.get_tables() and name not in [
+            c.name for c in db.get_columns(table)]:
+        migrate(migrator.add_column(table, name, field))
+
+
+def add_index(db, migrator, table, columns, unique=False):
+    from playhouse.migrate import migrate
+    name = '%s_%s' % (table, '_'.join(columns))
+    if table in db.get_tables() and name not in [
+            i.name for i in db.get_indexes(table)]:
+        migrate(migrator.add_index(table, columns, unique))
+
+
+@migration
+def initial_columns(db, migrator):
+    """Columns added to feed before migrations existed."""
+    add_column(db, migrator, 'feed', 'etag', CharField(null=True))
+    add_column(db, migrator, 'feed', 'modified', CharField(null=True))
+    add_column(db, migrator, 'feed', 'interval', IntegerField(null=True))
+    add_column(db, migrator, 'feed', 'next_poll', DateTimeField(null=True))
+    add_column(db, migrator, 'feed', 'changed', DateTimeField(null=True))
+    add_column(db, migrator, 'feed', 'errors', IntegerField(default=0))
+
+
+@migration
+def lookup_indexes(db, migrator):
+    """Indexes for pending outbox and scheduler lookups."""
+    add_index(db, migrator, 'outbox', ('status', 'next_attempt'))
+    add_index(db, migrator, 'feed', ('next_poll',))
+
+
+@migration
+def leases(db, migrator):
+    """Lease columns, so several runners can share feeds and outbox."""
+    add_column(db, migrator, 'feed', 'locked_by', CharField(null=True))
+    add_column(db, migrator, 'feed', 'lease_until', DateTimeField(null=True))
+    add_column(db, migrator, 'feed', 'last_polled', DateTimeField(null=True))
+    add_column(db, migrator, 'outbox', 'locked_by', CharField(null=True))
+
+
+@migration
+def feed_digest(db, migrator):
+    """Digest of the latest document of feeds."""
+    add_column(db, migrator, 'feed', 'digest', CharField(max_length=40, null=True))
+
+
+@migration
+def feed_health(db, migrator):
+    """Outcome of the latest fetch of feeds, and disabled dead ones."""
+    add_column(db, migrator, 'feed', 'last_status', CharField(null=True))
+    add_column(db, migrator, 'feed', 'last_http_status', IntegerField(null=True))
+    add_column(db, migrator, 'feed', 'last_success', DateTimeField(null=True))
+    add_column(db, migrator, 'feed', 'last_error', TextField(null=True))
+    add_column(db, migrator, 'feed', 'disabled', BooleanField(default=False))
+
+
+@migration
+def feed_order(db, migrator):
+    """Whether feeds list their newest entries first."""
+    add_column(db, migrator, 'feed', 'newest_first', BooleanField(null=True))
+
+
+def migrate_db(db, models):
+    """
+    Create missing tables and apply pending migrations, models must be
+    bound to db in the calling thread.
+    """
+    tables = db.get_tables()
+    fresh = not any(m._meta.table_name in tables for m in models)
+    db.create_tables([SchemaVersion], safe=True)
+
+    if fresh:
+        with db.atomic():
+            db.create_tables(models)
+            for version, func in enumerate(MIGRATIONS, 1):
+                SchemaVersion.create(version=version, name=func.__name__)
+        return
+
+    current = SchemaVersion.select(fn.MAX(SchemaVersion.version)).scalar() or 0
+    pending = MIGRATIONS[current:]
+    if pending:
+        from playhouse.migrate import SchemaMigrator
+        migrator = SchemaMigrator.from_database(db)
+    for version, func in enumerate(pending, current + 1):
+        logger.info('[db] apply migration %s (%s)' % (version, func.__name__))
+        with db.atomic():
+            func(db, migrator)
+            SchemaVersion.create(version=version, name=func.__name__)
+    db.create_tables(models, safe=True)
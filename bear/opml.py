@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
+
+
+def read_urls(path):
+    """Return feed urls of an OPML file or a text file, one url per line."""
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    if content.lstrip().startswith(b'<'):
+        root = ElementTree.fromstring(content)
+        return [outline.get('xmlUrl').strip()
+                for outline in root.iter('outline') if outline.get('xmlUrl')]
+
+    urls = []
+    for line in content.decode('utf-8').splitlines():
+        line = line.strip()
+        if line and not line.startswith('#'):
+            urls.append(line)
+    return urls
+
+
+def write_opml(feeds, f, title='Bear feeds'):
+    f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+    f.write('<opml version="2.0">\n')
+    f.write('  <head><title>%s</title></head>\n' % title)
+    f.write('  <body>\n')
+    for feed in feeds:
+        f.write('    <outline type="rss" text=%s xmlUrl=%s/>\n' % (
+            quoteattr(feed.url), quoteattr(feed.url)))
+    f.write('  </body>\n')
+    f.write('</opml>\n')
+
+
+def write_txt(feeds, f):
+    for feed in feeds:
+        f.write('%s\n' % feed.url)
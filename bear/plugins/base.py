@@ -16,6 +16,16 @@ settings_2 = test
 """
 
 
+def observer(func):
+    """
+    Mark a hook as observer only: it doesn't change its arguments, its
+    result is ignored and it is run in the background once every other
+    plugin is done with the signal.
+    """
+    func.observer = True
+    return func
+
+
 class BasePlugin:
     def __init__(self, **kwargs):
         self.config = kwargs
@@ -26,6 +36,9 @@ class BasePlugin:
     def pre_add_feed(self, url):
         raise NotImplementedError
 
+    def pre_add_feeds(self, urls):
+        raise NotImplementedError
+
     def post_add_feed(self, feed):
         raise NotImplementedError
 
@@ -44,5 +57,8 @@ class BasePlugin:
     def post_set_feed(self, feed):
         raise NotImplementedError
 
-    def pre_send_email(self, sender, to, subject, message, feed, entry):
+    def pre_send_email(self, sender, to, subject, message, feed, feed_parsed, entry):
+        raise NotImplementedError
+
+    def pre_send_digest(self, sender, to, subject, message, feed, feed_parsed, entries):
         raise NotImplementedError
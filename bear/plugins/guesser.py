@@ -5,19 +5,228 @@ Description
 This plugin will try to guess if you give feed url or website url.
 If website url is given, it will try to guess feed url.
 
+The page is searched for <link rel="alternate"> feeds, otherwise common
+feed paths are probed concurrently. Resolutions, failed ones included,
+are kept in cache_file (ttl and negative_ttl seconds, empty cache_file
+for none). Urls of a bulk import are resolved in parallel by workers
+threads.
+
 Install
 =======
 Nothing.
 
 Example
 =======
-Nothing.
+[plugin:guesser]
+cache_file = /tmp/bear-guesser.json
+paths = /feed,/atom.xml,/rss
+ttl = 2592000
+negative_ttl = 86400
+timeout = 10
+workers = 16
 """
+import os
+import re
+import json
+import time
 import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from urlparse import urljoin
+    from HTMLParser import HTMLParser
+except ImportError:
+    from urllib.parse import urljoin
+    from html.parser import HTMLParser
+
 from .base import BasePlugin
 
 logger = logging.getLogger('plugins.guesser')
 
+FEED_TYPES = (
+    'application/rss+xml',
+    'application/atom+xml',
+    'application/rdf+xml')
+FEED_RE = re.compile(br'<(rss|feed|rdf:rdf)[\s>]', re.IGNORECASE)
+SNIFF_SIZE = 2048
+
+
+class AlternateParser(HTMLParser):
+    """Collect feeds hrefs of <link rel="alternate"> tags in <head>."""
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.hrefs = []
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'body':
+            self.done = True
+        elif tag == 'link':
+            attrs = dict(attrs)
+            rel = (attrs.get('rel') or '').lower().split()
+            if 'alternate' in rel and attrs.get('href') and \
+                    (attrs.get('type') or '').lower() in FEED_TYPES:
+                self.hrefs.append(attrs['href'])
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.done = True
+
 
 class GuesserPlugin(BasePlugin):
-    pass
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.cache_file = self.config.get('cache_file', os.path.join(
+            tempfile.gettempdir(), 'bear-guesser.json'))
+        self.paths = [p.strip() for p in self.config.get(
+            'paths', '/feed,/atom.xml,/rss').split(',') if p.strip()]
+        self.ttl = int(self.config.get('ttl', 2592000))
+        self.negative_ttl = int(self.config.get('negative_ttl', 86400))
+        self.timeout = int(self.config.get('timeout', 10))
+        self.workers = int(self.config.get('workers', 16))
+        self.max_size = int(self.config.get('max_size', 1048576))
+        self._cache = None
+        self._hosts = None
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = {}
+            if self.cache_file and os.path.exists(self.cache_file):
+                try:
+                    with open(self.cache_file) as f:
+                        self._cache = json.load(f)
+                except (IOError, OSError, ValueError) as e:
+                    logger.error('%s not readable (%s)' % (self.cache_file, e))
+        return self._cache
+
+    def save_cache(self):
+        if not self.cache_file:
+            return
+        with self._lock:
+            data = json.dumps(self.cache)
+        tmp_path = '%s.%s.tmp' % (self.cache_file, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.rename(tmp_path, self.cache_file)
+        except (IOError, OSError) as e:
+            logger.error('%s not writable (%s)' % (self.cache_file, e))
+
+    def cached(self, url):
+        """Return (found, feed_url) of url from the cache."""
+        with self._lock:
+            hit = self.cache.get(url)
+        if hit is None:
+            return False, None
+        feed_url, resolved = hit
+        ttl = self.ttl if feed_url else self.negative_ttl
+        if time.time() - resolved > ttl:
+            return False, None
+        return True, feed_url
+
+    def remember(self, url, feed_url):
+        now = time.time()
+        with self._lock:
+            self.cache[url] = [feed_url, now]
+            if feed_url:
+                # Added right after, don't download it again
+                self.cache[feed_url] = [feed_url, now]
+
+    def get(self, url):
+        """Return the final url and the first max_size bytes of url."""
+        from bear.hosts import Hosts
+        from bear.fetcher import request, LimitedReader
+
+        with self._lock:
+            if self._hosts is None:
+                # Probes of a same site are concurrent, no delay between them
+                self._hosts = Hosts(max_connections=len(self.paths) + 1, delay=0)
+        headers = {'User-Agent': 'bear-guesser', 'Accept-Encoding': 'gzip'}
+        conn, response, url, host = request(
+            self._hosts, url, headers, self.timeout)
+        try:
+            if response.status != 200:
+                return url, None
+            chunks = []
+            size = 0
+            # Feeds links and markers are at the top, the rest is ignored
+            for chunk in LimitedReader(response, None).chunks():
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= self.max_size:
+                    break
+            return url, b''.join(chunks)
+        finally:
+            self._hosts.keep(conn, response)
+            self._hosts.release(host)
+
+    def is_feed(self, url):
+        try:
+            _, body = self.get(url)
+        except Exception as e:
+            logger.debug('%s probe failed (%s)' % (url, e))
+            return False
+        return body is not None and FEED_RE.search(body[:SNIFF_SIZE]) is not None
+
+    def alternates(self, url, body):
+        parser = AlternateParser()
+        for start in range(0, len(body), 16384):
+            parser.feed(body[start:start + 16384].decode('utf-8', 'replace'))
+            if parser.done:
+                break
+        return [urljoin(url, href) for href in parser.hrefs]
+
+    def guess(self, url):
+        """Return the feed url of url, None if none is found."""
+        try:
+            final_url, body = self.get(url)
+        except Exception as e:
+            logger.warning('%s not reachable (%s)' % (url, e))
+            return None
+        if body is None:
+            return None
+        if FEED_RE.search(body[:SNIFF_SIZE]):
+            return url
+
+        found = self.alternates(final_url, body)
+        if found:
+            return found[0]
+
+        candidates = [urljoin(final_url, path) for path in self.paths]
+        with ThreadPoolExecutor(max_workers=len(candidates) or 1) as executor:
+            for candidate, ok in zip(candidates, executor.map(self.is_feed, candidates)):
+                if ok:
+                    return candidate
+        return None
+
+    def resolve(self, url):
+        found, feed_url = self.cached(url)
+        if not found:
+            feed_url = self.guess(url)
+            self.remember(url, feed_url)
+            if feed_url is None:
+                logger.warning('no feed found for %s' % url)
+            elif feed_url != url:
+                logger.info('%s guessed for %s' % (feed_url, url))
+        # Unresolved urls are added as given
+        return feed_url or url
+
+    def pre_add_feed(self, url):
+        found = self.cached(url)[0]
+        url = self.resolve(url)
+        if not found:
+            self.save_cache()
+        return url
+
+    def pre_add_feeds(self, urls):
+        pending = [url for url in set(urls) if not self.cached(url)[0]]
+        if pending:
+            logger.info('resolving %s url(s)' % len(pending))
+            with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+                list(executor.map(self.resolve, pending))
+            self.save_cache()
+        return [self.resolve(url) for url in urls]
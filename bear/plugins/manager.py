@@ -1,14 +1,137 @@
 # -*- coding: utf-8 -*-
+import time
 import logging
+import threading
 from importlib import import_module
 
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from .base import BasePlugin
+
 logger = logging.getLogger('pluginmanager')
 
+SIGNALS = tuple(sorted(
+    name for name in vars(BasePlugin)
+    if name.startswith('pre_') or name.startswith('post_')))
+
+
+class Observers:
+    """
+    Run observer hooks on a few daemon threads. Their errors are logged
+    and never reach the caller. Hooks running for more than timeout
+    seconds are abandoned to their thread and their worker is replaced,
+    so a hung hook never holds the queue nor close().
+    """
+    def __init__(self, workers=4, timeout=30):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.queue = Queue()
+        self._workers = []
+        self._running = {}
+        self._watcher = None
+        self._lock = threading.Lock()
+
+    def submit(self, name, signal, hook, args):
+        with self._lock:
+            self._start()
+        self.queue.put((name, signal, hook, args))
+
+    def _start(self):
+        # Called with _lock held
+        while len(self._workers) < self.workers:
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        if self.timeout and self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch)
+            self._watcher.daemon = True
+            self._watcher.start()
+
+    def join(self, timeout=None):
+        """Wait for submitted hooks, return False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self):
+        if not self._workers:
+            return
+        if not self.join(self.timeout):
+            logger.warning('[plugins] %s observer hook(s) still running, abandoned' % (
+                self.queue.unfinished_tasks))
+        with self._lock:
+            # Workers of abandoned hooks exit once they are done
+            for _ in self._workers:
+                self.queue.put(None)
+            self._workers = []
+
+    def _watch(self):
+        while True:
+            time.sleep(min(1.0, self.timeout / 2.0))
+            with self._lock:
+                if not self._workers:
+                    self._watcher = None
+                    return
+                now = time.time()
+                for worker, (name, signal, start) in list(self._running.items()):
+                    if now - start <= self.timeout:
+                        continue
+                    logger.warning('[plugin-%s] %s still running after %ss, abandoned' % (
+                        name, signal, self.timeout))
+                    del self._running[worker]
+                    self._workers.remove(worker)
+                    self.queue.task_done()
+                self._start()
+
+    def _work(self):
+        worker = threading.current_thread()
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            name, signal, hook, args = task
+            with self._lock:
+                self._running[worker] = (name, signal, time.time())
+            try:
+                hook(*args)
+            except NotImplementedError:
+                pass
+            except Exception as e:
+                logger.exception('[plugin-%s] %s failed (%s)' % (name, signal, e))
+            finally:
+                with self._lock:
+                    abandoned = self._running.pop(worker, None) is None
+            if abandoned:
+                # Task already done for the queue, worker replaced
+                return
+            self.queue.task_done()
+
 
 class PluginManager:
-    def __init__(self, conf):
+    def __init__(self, conf, workers=4, timeout=30):
         self.conf = conf
-        self.load_plugins()
+        # Plugins (and their dependencies) are imported on first use,
+        # commands which never run a signal don't pay for them
+        self._plugins = None
+        self.hooks = None
+        self.observer_hooks = None
+        self.observers = Observers(workers, timeout)
+
+    @property
+    def plugins(self):
+        if self._plugins is None:
+            self.load_plugins()
+        return self._plugins
 
     def get_plugin_module(self, name):
         return import_module('bear.plugins.%s' % name)
@@ -18,14 +141,31 @@ class PluginManager:
             'bear.plugins.%s' % name), '%sPlugin' % name.title())
 
     def load_plugins(self):
-        self.plugins = {}
+        self._plugins = {}
         for plugin in self.conf:
             try:
                 plugin_class = self.get_plugin_class(plugin)
             except ImportError:
                 logger.error('[plugin-%s] not exists' % plugin)
-            self.plugins[plugin] = plugin_class(**self.conf[plugin])
-            self.plugins[plugin].dependencies()
+                continue
+            self._plugins[plugin] = plugin_class(**self.conf[plugin])
+            self._plugins[plugin].dependencies()
+        self.compile_hooks()
+
+    def compile_hooks(self):
+        # Only keep, for each signal, plugins which override the
+        # BasePlugin stub so dispatch doesn't pay for the others
+        self.hooks = {}
+        self.observer_hooks = {}
+        for name, plugin in self.plugins.items():
+            for signal in SIGNALS:
+                method = getattr(type(plugin), signal, None)
+                if method is None or method is getattr(BasePlugin, signal):
+                    continue
+                hooks = self.observer_hooks if getattr(
+                    method, 'observer', False) else self.hooks
+                hooks.setdefault(signal, []).append(
+                    (name, getattr(plugin, signal)))
 
     def get_plugin_help(self, name):
         try:
@@ -34,32 +174,44 @@ class PluginManager:
         except ImportError:
             logger.info('[plugin-%s] not exists' % name)
 
+    def close(self):
+        self.observers.close()
+
     def run_signal(self, signal, *args):
-        # Get initial args given by Bear to
+        # Get initial args given by Bear to
         # check if plugin return good number
         args_count = len(args)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if self.hooks is None:
+            self.load_plugins()
 
-        for name, plugin in self.plugins.items():
+        for name, hook in self.hooks.get(signal, ()):
             try:
-                _args = getattr(plugin, signal)(*args)
-                # If plugin method return only one item it must
-                # be converted in tuple for following plugin
-                if not isinstance(_args, tuple):
-                    _args = (_args, )
+                _args = hook(*args)
+            except NotImplementedError:
+                if debug:
+                    logger.debug('[plugin-%s] %s not implemented' % (name, signal))
+                continue
+            # If plugin method return only one item it must
+            # be converted in tuple for following plugin
+            if not isinstance(_args, tuple):
+                _args = (_args, )
+            if debug:
                 msg = '[plugin-%s] %s (args:%s)' % (name, signal, args)
                 if len(msg) > 90:
                     msg = msg[:90] + ' [...truncated...]'
                 logger.debug(msg)
-                # If plugin method doesn't return initial count of
-                # args sent by Bear, ignore this plugin work
-                if len(_args) != args_count:
-                    logger.error('[plugin-%s] %s not return good number of args (ignored)' % (
-                        name, signal))
-                else:
-                    args = _args
-            except NotImplementedError:
-                logger.debug('[plugin-%s] %s not implemented' % (name, signal))
-        # If latest plugin return only one item it must
+            # If plugin method doesn't return initial count of
+            # args sent by Bear, ignore this plugin work
+            if len(_args) != args_count:
+                logger.error('[plugin-%s] %s not return good number of args (ignored)' % (
+                    name, signal))
+            else:
+                args = _args
+        # Observers see the final args and the caller doesn't wait
+        for name, hook in self.observer_hooks.get(signal, ()):
+            self.observers.submit(name, signal, hook, args)
+        # If latest plugin return only one item it must
         # be converted in tuple to be unpacked by Bear
         if args_count > 1:
             return tuple(args)
@@ -4,19 +4,146 @@ Description
 ===========
 This plugin provide a summarize of a entry description.
 
+Entry description HTML is reduced to plain text, without scripts,
+styles nor embedded data URIs, and cut after max_sentences sentences
+(0 for no limit) or max_length characters. Default email messages are
+replaced by the summary, also available to templates as
+entry.summary_text. Messages built by other plugins are kept.
+The description is read in a single pass which stops as soon as the
+summary is complete, large entries cost no more than their summary.
+
 Install
 =======
 Nothing.
 
 Example
 =======
-Nothing.
+[plugin:summarize]
+max_length = 500
+max_sentences = 3
 """
+import re
 import logging
+
+from html import escape
+from html import unescape
+
 from .base import BasePlugin
 
 logger = logging.getLogger('plugins.summarize')
 
+# Unclosed tags and comments run to the end, so a failed match never
+# scans the rest of the document again
+TAG_RE = re.compile(r'<!--.*?(?:-->|$)|<(/?)([a-zA-Z][a-zA-Z0-9]*)[^>]*(?:>|$)', re.S)
+SKIP_TAGS = ('script', 'style', 'head', 'title', 'template', 'noscript', 'svg')
+SKIP_END_RE = dict(
+    (tag, re.compile(r'</%s\s*>' % tag, re.I)) for tag in SKIP_TAGS)
+BLOCK_TAGS = frozenset((
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl',
+    'dt', 'figcaption', 'figure', 'footer', 'h1', 'h2', 'h3', 'h4', 'h5',
+    'h6', 'header', 'hr', 'li', 'ol', 'p', 'pre', 'section', 'table',
+    'td', 'th', 'tr', 'ul'))
+# Only real data URIs (data:type/subtype[;params],payload), not prose
+DATA_URI_RE = re.compile(r'\bdata:[\w.+-]+/[\w.+-]+(?:;[^,\s]*)?,[^\s"\'<>]*')
+SPACES_RE = re.compile(r'\s+')
+SPACE_RE = re.compile(r'\s')
+TEXT_WINDOW = 8192
+SENTENCE_END_RE = re.compile(r'[.!?]+(?=\s|$)')
+
+
+def summarize(html, max_length=500, max_sentences=3):
+    """Return the first sentences of html as plain text."""
+    parts = []
+    state = {'length': 0, 'sentences': 0, 'space': True}
+
+    def emit(text):
+        # Return True once the summary is complete
+        text = SPACES_RE.sub(' ', unescape(DATA_URI_RE.sub('', text)))
+        if state['space']:
+            text = text.lstrip(' ')
+        if not text:
+            return False
+        if max_sentences:
+            for match in SENTENCE_END_RE.finditer(text):
+                state['sentences'] += 1
+                if state['sentences'] >= max_sentences:
+                    text = text[:match.end()]
+                    break
+        if max_length and state['length'] + len(text) > max_length:
+            text = text[:max_length - state['length']]
+            if ' ' in text:
+                text = text.rsplit(' ', 1)[0]
+            parts.append(text.rstrip() + u'…')
+            return True
+        parts.append(text)
+        state['length'] += len(text)
+        state['space'] = text.endswith(' ')
+        return bool(max_sentences) and state['sentences'] >= max_sentences
+
+    pos = 0
+    size = len(html)
+    while pos < size:
+        match = TAG_RE.search(html, pos)
+        end = match.start() if match else size
+        # Long texts are read by windows cut on whitespace, which
+        # never splits words, entities nor data URIs
+        done = False
+        while end > pos and not done:
+            cut = end
+            if end - pos > TEXT_WINDOW:
+                space = SPACE_RE.search(html, pos + TEXT_WINDOW, end)
+                if space is not None:
+                    cut = space.start()
+            done = emit(html[pos:cut])
+            pos = cut
+        if done:
+            break
+        if match is None:
+            break
+        pos = match.end()
+        closing, tag = match.group(1), (match.group(2) or '').lower()
+        if tag in SKIP_END_RE and not closing:
+            skipped = SKIP_END_RE[tag].search(html, pos)
+            pos = skipped.end() if skipped else size
+        elif tag in BLOCK_TAGS and not state['space']:
+            parts.append(' ')
+            state['length'] += 1
+            state['space'] = True
+    return ''.join(parts).strip()
+
 
 class SummarizePlugin(BasePlugin):
-    pass
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.max_length = int(self.config.get('max_length', 500))
+        self.max_sentences = int(self.config.get('max_sentences', 3))
+
+    def summarize(self, entry):
+        summary = entry.get('summary_text')
+        if summary is None:
+            summary = summarize(
+                entry.get('description') or '',
+                max_length=self.max_length,
+                max_sentences=self.max_sentences)
+            entry['summary_text'] = summary
+        return summary
+
+    def pre_send_email(self, sender, to, subject, message, feed, feed_parsed, entry):
+        from bear.core import email_body
+
+        summary = self.summarize(entry)
+        if message == email_body(entry):
+            message = '<strong><a href="%s">Go to website</a></strong><hr> <p>%s</p>' % (
+                entry.get('link'), escape(summary))
+        return sender, to, subject, message, feed, feed_parsed, entry
+
+    def pre_send_digest(self, sender, to, subject, message, feed, feed_parsed, entries):
+        from bear.core import digest_body
+
+        summaries = [self.summarize(e) for e in entries]
+        if message == digest_body(entries):
+            message = ''.join(
+                '<h3><a href="%s">%s</a></h3><p>%s</p><hr>' % (
+                    e.get('link'), e.get('title'), escape(summary))
+                for e, summary in zip(entries, summaries))
+        return sender, to, subject, message, feed, feed_parsed, entries
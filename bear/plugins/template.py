@@ -6,6 +6,12 @@ This plugin allow you to set a custom subject and message for your emails.
 Template rendering is provided by Jinja2.
 Subject rendering is provided by python String format method.
 
+Templates are compiled once, cached on disk (cache_dir) and only
+reloaded when their file is modified. A feed can have its own template,
+named after its id in feed_templates directory (ie: 12.html).
+digest_template_file is used to render all new entries of a feed at
+once when emails are sent in batch.
+
 Install
 =======
 pip install jinja2
@@ -15,50 +21,117 @@ Example
 [plugin:template]
 subject = [{feed_parsed.feed.title}] {entry.title}
 template_file = /tmp/example.html
+feed_templates = /tmp/templates
+digest_subject = [{feed_parsed.feed.title}] {count} new entries
+digest_template_file = /tmp/digest.html
+cache_dir = /tmp/bear-templates
 """
 import os
 import sys
 import logging
+from importlib.util import find_spec
 
 from .base import BasePlugin
 
 logger = logging.getLogger('plugins.template')
 
 
+def load_template_source(path):
+    # Jinja calls uptodate() before using a cached template,
+    # so files are only read and compiled again when modified
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with open(path, 'rb') as f:
+        source = f.read().decode('utf-8')
+
+    def uptodate():
+        try:
+            return os.path.getmtime(path) == mtime
+        except OSError:
+            return False
+    return source, path, uptodate
+
+
 class TemplatePlugin(BasePlugin):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.template_file = self.config.get('template_file')
+        self.feed_templates = self.config.get('feed_templates')
+        self.digest_template_file = self.config.get('digest_template_file')
         self.subject = self.config.get('subject')
+        self.digest_subject = self.config.get('digest_subject')
 
         if self.template_file is None:
             logger.debug('no template_file set')
         if self.config.get('subject') is None:
             logger.debug('no subject set')
 
-        if self.template_file and os.path.exists(self.template_file):
-            self._load_template()
-        elif self.template_file:
-            logger.error('template_file does not exists')
+        for path in (self.template_file, self.digest_template_file):
+            if path and not os.path.exists(path):
+                logger.error('%s does not exists' % path)
+
+        # Bound once, str.format parsing is done in C
+        self.format_subject = self.subject.format if self.subject else None
+        self.format_digest_subject = (
+            self.digest_subject.format if self.digest_subject else None)
+        self.environment = None
 
     def dependencies(self):
-        try:
-            import jinja2
-        except ImportError:
+        # Jinja2 itself is imported on first render only
+        if find_spec('jinja2') is None:
             logger.error('Template plugin need Jinja2 (pip install jinja2).')
             sys.exit(1)
 
-    def _load_template(self):
-        from jinja2 import Template
-        self.template = Template(open(self.config.get('template_file')).read())
+    def _load_environment(self):
+        from jinja2 import Environment
+        from jinja2 import FunctionLoader
+        from jinja2 import FileSystemBytecodeCache
+
+        cache_dir = self.config.get('cache_dir')
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.environment = Environment(
+            loader=FunctionLoader(load_template_source),
+            bytecode_cache=FileSystemBytecodeCache(cache_dir),
+            auto_reload=True)
+
+    def get_template(self, feed, path):
+        if self.feed_templates and feed is not None:
+            feed_path = os.path.join(self.feed_templates, '%s.html' % feed.id)
+            if os.path.exists(feed_path):
+                path = feed_path
+        if not path:
+            # Nothing to render, Jinja2 isn't needed
+            return None
+        if self.environment is None:
+            self._load_environment()
+        from jinja2 import TemplateNotFound
+        try:
+            return self.environment.get_template(path)
+        except TemplateNotFound:
+            logger.error('%s does not exists' % path)
 
     def pre_send_email(self, sender, to, subject, message, feed, feed_parsed, entry):
-        if self.subject:
-            subject = self.subject.format(
+        if self.format_subject:
+            subject = self.format_subject(
+                feed=feed, feed_parsed=feed_parsed, entry=entry)
+        template = self.get_template(feed, self.template_file)
+        if template is not None:
+            message = template.render(
                 feed=feed, feed_parsed=feed_parsed, entry=entry)
-        if self.template_file:
-            message = self.template.render(feed=feed, entry=entry)
         return sender, to, subject, message, feed, feed_parsed, entry
 
+    def pre_send_digest(self, sender, to, subject, message, feed, feed_parsed, entries):
+        if self.format_digest_subject:
+            subject = self.format_digest_subject(
+                feed=feed, feed_parsed=feed_parsed, count=len(entries))
+        template = self.get_template(None, self.digest_template_file)
+        if template is not None:
+            message = template.render(
+                feed=feed, feed_parsed=feed_parsed, entries=entries)
+        return sender, to, subject, message, feed, feed_parsed, entries
+
     def help(self):
         print(__doc__)
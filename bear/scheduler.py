@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import heapq
+from datetime import datetime
+from datetime import timedelta
+from time import time
+
+
+def parse_retry_after(value):
+    """Return Retry-After header value (seconds or HTTP date) in seconds."""
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        from email.utils import parsedate_tz
+        from email.utils import mktime_tz
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, int(mktime_tz(date) - time()))
+
+
+class Scheduler:
+    """
+    Compute feeds next poll time from their observed update frequency
+    and keep upcoming polls in a priority queue.
+    """
+    def __init__(self, min_interval=300, max_interval=86400,
+                 default_interval=3600, backoff=1.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_interval = default_interval
+        self.backoff = backoff
+        self.queue = []
+
+    def clamp(self, interval):
+        return int(min(self.max_interval, max(self.min_interval, interval)))
+
+    def load(self, feeds, now=None):
+        self.queue = []
+        now = now or datetime.now()
+        for feed in feeds:
+            self.queue.append((feed.next_poll or now, feed.id))
+        heapq.heapify(self.queue)
+
+    def push(self, feed):
+        heapq.heappush(self.queue, (feed.next_poll, feed.id))
+
+    def pop_due(self, now=None):
+        now = now or datetime.now()
+        due = []
+        found = set()
+        while self.queue and self.queue[0][0] <= now:
+            feed_id = heapq.heappop(self.queue)[1]
+            if feed_id not in found:
+                found.add(feed_id)
+                due.append(feed_id)
+        return due
+
+    def next_due(self):
+        if self.queue:
+            return self.queue[0][0]
+
+    def reschedule(self, feed, new_entries=0, ttl=None, retry_after=None,
+                   error=False, now=None):
+        now = now or datetime.now()
+        interval = feed.interval or self.default_interval
+
+        if error:
+            feed.errors = (feed.errors or 0) + 1
+            delay = interval * 2 ** min(feed.errors, 16)
+        else:
+            feed.errors = 0
+            if new_entries:
+                # Move the estimate toward the time it took
+                # to publish each of the new entries
+                if feed.changed is not None:
+                    gap = (now - feed.changed).total_seconds() / new_entries
+                    interval = (interval + gap) / 2.
+                feed.changed = now
+            else:
+                interval *= self.backoff
+            interval = self.clamp(interval)
+            if ttl:
+                interval = max(interval, ttl * 60)
+            feed.interval = interval
+            delay = interval
+
+        delay = min(delay, self.max_interval)
+        if retry_after:
+            delay = max(delay, retry_after)
+        feed.next_poll = now + timedelta(seconds=delay)
+        self.push(feed)
+        return feed.next_poll
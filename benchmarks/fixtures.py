@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP and SMTP servers used by tests and benchmarks, serving
+synthetic feeds and keeping every received email.
+"""
+import gzip
+import time
+import threading
+from datetime import datetime
+from datetime import timedelta
+
+try:
+    from SocketServer import TCPServer
+    from SocketServer import ThreadingMixIn
+    from SocketServer import StreamRequestHandler
+except ImportError:
+    from socketserver import TCPServer
+    from socketserver import ThreadingMixIn
+    from socketserver import StreamRequestHandler
+
+try:
+    from BaseHTTPServer import HTTPServer
+    from BaseHTTPServer import BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer
+    from http.server import BaseHTTPRequestHandler
+
+RFC822 = '%a, %d %b %Y %H:%M:%S GMT'
+
+
+def make_article(paragraphs=40, image_size=200000):
+    """Build a whole article HTML with an inline base64 image."""
+    text = '<p>%s</p>' % ('Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 8)
+    return (
+        '<div class="post"><style>.post { margin: 0 }</style>'
+        '<h2>Article</h2><img alt="cover" src="data:image/png;base64,%s">%s</div>' % (
+            'iVBORw0KGgo' * (image_size // 11), text * paragraphs))
+
+
+def make_rss(title, entries=20, description_size=500, start=0, updated=None):
+    """
+    Build an RSS 2.0 document, newest entry first. entries is a number
+    of generated entries or a list of entry ids, also used as titles.
+    An empty updated builds a document without any date.
+    """
+    now = datetime(2014, 1, 6, 10, 0)
+    items = []
+    if isinstance(entries, int):
+        body = ('lorem ipsum ' * (description_size // 12 + 1))[:description_size]
+        for i in range(start + entries, start, -1):
+            items.append((
+                '%s entry %s' % (title, i), '%s/%s' % (title, i),
+                '%s-%s' % (title, i), body, now + timedelta(minutes=i)))
+        last = now + timedelta(minutes=start + entries)
+    else:
+        for i in entries:
+            items.append((i, i, i, '%s body' % i, None))
+        last = now
+    if updated is None:
+        updated = last.strftime(RFC822)
+    return (
+        '<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+        '<title>%s</title><link>http://example.com/%s</link>%s%s'
+        '</channel></rss>' % (
+            title, title,
+            '<lastBuildDate>%s</lastBuildDate>' % updated if updated else '',
+            ''.join(
+                '<item><title>%s</title>'
+                '<link>http://example.com/%s</link>'
+                '<guid isPermaLink="false">%s</guid>%s'
+                '<description>%s</description></item>' % (
+                    item_title, link, guid,
+                    '<pubDate>%s</pubDate>' % published.strftime(RFC822)
+                    if published and updated else '',
+                    description)
+                for item_title, link, guid, description, published in items)
+        )).encode('utf-8')
+
+
+def make_atom(title, entries=20, description_size=500, start=0):
+    """Build an Atom document, newest entry first."""
+    now = datetime(2014, 1, 6, 10, 0)
+    body = ('lorem ipsum ' * (description_size // 12 + 1))[:description_size]
+    items = []
+    for i in range(start + entries, start, -1):
+        items.append(
+            '<entry><title>%s entry %s</title>'
+            '<link href="http://example.com/%s/%s"/>'
+            '<id>urn:%s:%s</id><updated>%s</updated>'
+            '<summary>%s</summary></entry>' % (
+                title, i, title, i, title, i,
+                (now + timedelta(minutes=i)).isoformat() + 'Z', body))
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<feed xmlns="http://www.w3.org/2005/Atom">'
+        '<title>%s</title><link href="http://example.com/%s"/>'
+        '<updated>%s</updated>%s</feed>' % (
+            title, title,
+            (now + timedelta(minutes=start + entries)).isoformat() + 'Z',
+            ''.join(items))).encode('utf-8')
+
+
+class FeedServer(ThreadingMixIn, HTTPServer):
+    """
+    Serve feeds from a path -> body dict. statuses maps a path to the
+    (code, headers) of an empty response, etags enables conditional
+    requests of a path.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, delay=0):
+        self.feeds = {}
+        self.etags = {}
+        self.statuses = {}
+        self.gzip = False
+        self.delay = delay
+        self.requests = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FeedRequestHandler)
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s%s' % (self.server_port, path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients drop kept-alive connections of truncated downloads
+        pass
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't let Nagle
+    # delay the body on kept-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        with self.server._lock:
+            self.server.connections += 1
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        body = self.server.feeds.get(self.path)
+        status = self.server.statuses.get(self.path)
+        if body is None or status is not None:
+            code, headers = status or (404, {})
+            self.send_response(code)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = self.server.etags.get(self.path)
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/rss+xml')
+        if self.server.gzip:
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SMTPSink(ThreadingMixIn, TCPServer):
+    """Accept every email and keep its data."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        TCPServer.__init__(self, ('127.0.0.1', 0), SMTPSinkHandler)
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SMTPSinkHandler(StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        with self.server._lock:
+            self.server.connections += 1
+        self.reply('220 localhost')
+        data = None
+        for line in self.rfile:
+            line = line.rstrip(b'\r\n')
+            if data is not None:
+                if line == b'.':
+                    self.server.messages.append(b'\n'.join(data))
+                    data = None
+                    self.reply('250 OK')
+                else:
+                    data.append(line[1:] if line.startswith(b'..') else line)
+                continue
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.reply('250 localhost')
+            elif command == b'DATA':
+                data = []
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Bear benchmarks.
+
+Serve synthetic feeds and sink emails locally, then time the fetch,
+plugin and email stages. Results are printed as JSON.
+
+Usage:
+    run.py [--quick] [--only=<names>] [--output=<path>]
+
+Options:
+    --quick            Smaller workloads, for a fast sanity run
+    --only=<names>     Comma separated list of benchmarks to run
+    --output=<path>    Write JSON results to this file instead of stdout
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bear import Bear
+from bear import __version__
+from bear.plugins import PluginManager
+
+from fixtures import FeedServer
+from fixtures import SMTPSink
+from fixtures import make_rss
+from fixtures import make_atom
+from fixtures import make_article
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+class Context:
+    def __init__(self, quick=False):
+        self.quick = quick
+        self.tmp_dir = tempfile.mkdtemp(prefix='bear-bench-')
+        self.server = FeedServer()
+        self.smtp = SMTPSink()
+        self.bears = []
+
+    def close(self):
+        for bear in self.bears:
+            bear.close()
+        self.server.stop()
+        self.smtp.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def bear(self, fetch=None, **settings):
+        name = 'bear-%s' % len(self.bears)
+        settings_path = os.path.join(self.tmp_dir, '%s.ini' % name)
+        db_path = os.path.join(self.tmp_dir, '%s.db' % name)
+        with open(settings_path, 'w') as f:
+            f.write('[settings]\ndb_path = %s\nlog_file =\nlog_level = error\n' % db_path)
+            for key, value in settings.items():
+                f.write('%s = %s\n' % (key, value))
+            f.write('[email]\nhost = 127.0.0.1\nport = %s\n' % self.smtp.port)
+            f.write('[fetch]\n')
+            for key, value in (fetch or {}).items():
+                f.write('%s = %s\n' % (key, value))
+        bear = Bear(settings_path=settings_path)
+        bear.initialize_db()
+        self.bears.append(bear)
+        return bear
+
+
+def measure(name, setup, count, unit, **extra):
+    """
+    Return wall time, rate and peak memory of the function returned by
+    setup. It is run twice, from a fresh setup each time, so that
+    tracemalloc overhead doesn't skew timings.
+    """
+    func = setup()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+
+    func = setup()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {
+        'name': name,
+        'seconds': round(seconds, 6),
+        'count': count,
+        'unit': unit,
+        'per_second': round(count / seconds, 2) if seconds else None,
+        'peak_memory': peak}
+    result.update(extra)
+    return result
+
+
+@benchmark
+def fetch_feed(ctx):
+    results = []
+    sizes = [20, 200] if ctx.quick else [20, 200, 2000]
+    for make in (make_rss, make_atom):
+        for entries in sizes:
+            path = '/%s-%s.xml' % (make.__name__, entries)
+            first = make(path, entries=entries)
+            # A few new entries on top of an already fetched feed
+            update = make(path, entries=entries, start=5)
+            params = {'format': make.__name__[5:], 'entries': entries,
+                      'bytes': len(first)}
+
+            def setup_first():
+                ctx.server.feeds[path] = first
+                bear = ctx.bear(fetch={'host_delay': 0})
+                feed_id = bear.add_feed(ctx.server.url(path))
+                return lambda: bear.fetch_feed(feed_id=feed_id)
+
+            def setup_update():
+                func = setup_first()
+                func()
+                ctx.server.feeds[path] = update
+                return func
+
+            results.append(measure(
+                'fetch_feed.first', setup_first, 1, 'feeds', **params))
+            results.append(measure(
+                'fetch_feed.update', setup_update, 1, 'feeds', **params))
+    return results
+
+
+@benchmark
+def fetch_all(ctx):
+    results = []
+    count = 50 if ctx.quick else 500
+    ctx.server.delay = 0.02
+    for workers in (1, 8, 32):
+        def setup():
+            # Every feed is served by the same local host, stands
+            # for as many different hosts as workers
+            bear = ctx.bear(workers=workers, fetch={
+                'host_connections': workers, 'host_delay': 0})
+            for i in range(count):
+                path = '/all-%s-%s.xml' % (len(ctx.bears), i)
+                ctx.server.feeds[path] = make_rss(path, entries=20)
+                bear.add_feed(ctx.server.url(path))
+            return bear.fetch_feeds
+
+        results.append(measure(
+            'fetch_all', setup, count, 'feeds',
+            workers=workers, server_delay=ctx.server.delay))
+    ctx.server.delay = 0
+    return results
+
+
+@benchmark
+def run_signal(ctx):
+    count = 10000 if ctx.quick else 100000
+    manager = PluginManager(dict((name, {}) for name in ('guesser', 'summarize')))
+    path = '/signal.xml'
+    ctx.server.feeds[path] = make_rss(path, entries=1)
+    bear = ctx.bear()
+    feed = bear.get_feed(feed_id=bear.add_feed(ctx.server.url(path)))
+    d = bear.parse_feed(feed)
+    entry = d.entries[0]
+
+    def setup():
+        def run():
+            for _ in range(count):
+                manager.run_signal(
+                    'pre_send_email', 'from', 'to', 'subject', 'message',
+                    feed, d, entry)
+        return run
+    return [measure('run_signal.pre_send_email', setup, count, 'calls',
+                    plugins=len(manager.plugins))]
+
+
+@benchmark
+def summarize(ctx):
+    from feedparser import FeedParserDict
+    from bear.core import email_body
+    from bear.plugins.summarize import SummarizePlugin
+
+    count = 50 if ctx.quick else 500
+    plugin = SummarizePlugin()
+    results = []
+    for image_size in (0, 200000):
+        description = make_article(image_size=image_size)
+
+        def setup():
+            # Summaries are kept on entries, every run needs fresh ones
+            entries = [FeedParserDict(
+                link='http://example.com/%s' % i, title='Entry %s' % i,
+                description=description) for i in range(count)]
+            # Default message, as built by Bear.send_email
+            messages = [email_body(entry) for entry in entries]
+
+            def run():
+                for entry, message in zip(entries, messages):
+                    plugin.pre_send_email(
+                        'from', 'to', 'subject', message, None, None, entry)
+            return run
+        entry = FeedParserDict(link='http://example.com/', description=description)
+        message = plugin.pre_send_email(
+            'from', 'to', 'subject', email_body(entry), None, None, entry)[3]
+        results.append(measure(
+            'summarize.pre_send_email', setup, count, 'emails',
+            bytes=len(description), image_bytes=image_size,
+            message_bytes=len(message)))
+    return results
+
+
+@benchmark
+def send_email(ctx):
+    count = 200 if ctx.quick else 2000
+    path = '/emails.xml'
+    ctx.server.feeds[path] = make_rss(path, entries=count, description_size=2000)
+
+    def setup_render():
+        bear = ctx.bear()
+        bear.config['email']['to'] = 'bench@localhost'
+        feed = bear.get_feed(feed_id=bear.add_feed(ctx.server.url(path)))
+        d = bear.parse_feed(feed)
+
+        def render():
+            with bear.db.atomic():
+                for entry in d.entries:
+                    bear.send_email(feed, d, entry)
+        return render
+
+    def setup_deliver():
+        setup_render()()
+        return ctx.bears[-1].flush_outbox
+
+    sent = len(ctx.smtp.messages)
+    results = [
+        measure('send_email.render', setup_render, count, 'emails'),
+        measure('send_email.deliver', setup_deliver, count, 'emails')]
+    results[-1]['delivered'] = (len(ctx.smtp.messages) - sent) // 2
+    return results
+
+
+@benchmark
+def startup(ctx):
+    count = 5 if ctx.quick else 20
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = os.path.join(root, 'scripts', 'bear')
+    env = dict(os.environ, PYTHONPATH=root)
+    bear = ctx.bear(plugins='template')
+    bear.import_feeds(['http://127.0.0.1/%s.xml' % i for i in range(100)])
+    settings = '--settings=%s' % bear.settings_path
+
+    results = []
+    for name, args in (
+            ('import', ['-c', 'import bear']),
+            ('feeds', [script, 'feeds', settings]),
+            ('add', [script, 'add', 'http://127.0.0.1/new.xml', settings]),
+            ('help-plugin', [script, 'help-plugin', 'template', settings])):
+        def setup():
+            def run():
+                for _ in range(count):
+                    subprocess.check_call(
+                        [sys.executable] + args, env=env,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            return run
+        results.append(measure('startup.%s' % name, setup, count, 'runs'))
+    return results
+
+
+def main():
+    args = docopt(__doc__)
+    only = args.get('--only')
+    only = only.split(',') if only else None
+
+    ctx = Context(quick=args.get('--quick'))
+    results = []
+    try:
+        for func in BENCHMARKS:
+            if only is None or func.__name__ in only:
+                results.extend(func(ctx))
+    finally:
+        ctx.close()
+
+    report = json.dumps({
+        'bear': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': int(time.time()),
+        'results': results}, indent=2, sort_keys=True)
+    if args.get('--output'):
+        with open(args.get('--output'), 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+if __name__ == '__main__':
+    main()
@@ -39,7 +39,7 @@ setup(
     install_requires=[
         'feedparser==5.1.3',
         'docopt==0.6.1',
-        'peewee==2.2.2',
+        'peewee>=3.0',
         'colorlog==2.0.0'],
     classifiers=[
         'Intended Audience :: Developers',
@@ -1,9 +1,30 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import sys
+import time
+import shutil
+import tempfile
 import unittest
 from tempfile import mkstemp
+from datetime import datetime
+from datetime import timedelta
 from bear import Bear
+from bear.cache import ResponseCache
+from bear.fetcher import fetch
+from bear.plugins import PluginManager
+from bear.plugins.base import BasePlugin
+from bear.plugins.base import observer
+from bear.metrics import summarize
+from bear.scheduler import Scheduler
+
+# Local HTTP and SMTP servers are shared with the benchmarks
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from fixtures import FeedServer
+from fixtures import SMTPSink
+from fixtures import make_rss
 
 
 class BearTestCase(unittest.TestCase):
@@ -34,6 +55,29 @@ class BearTestCase(unittest.TestCase):
         feed = self.bear.get_feed(feed_id=feed_id)
         self.assertEqual(feed.id, feed_id)
 
+    def test_import_feeds(self):
+        self.bear.add_feed('http://a/feed')
+        feed_ids = self.bear.import_feeds(
+            ['http://a/feed', 'http://b/feed', 'http://c/feed', 'http://b/feed'])
+        self.assertEqual(len(feed_ids), 2)
+        self.assertEqual(
+            sorted(f.url for f in self.bear.get_feeds()),
+            ['http://a/feed', 'http://b/feed', 'http://c/feed'])
+
+    def test_opml_round_trip(self):
+        from bear.opml import read_urls, write_opml
+        self.bear.import_feeds(['http://a/feed?x=1&y=2', 'http://b/feed'])
+        path = mkstemp()[1]
+        self.addCleanup(os.remove, path)
+        with open(path, 'w') as f:
+            write_opml(self.bear.get_feeds(), f)
+        self.assertEqual(
+            read_urls(path), ['http://a/feed?x=1&y=2', 'http://b/feed'])
+
+        with open(path, 'w') as f:
+            f.write('# feeds\nhttp://a/feed\n\nhttp://c/feed\n')
+        self.assertEqual(read_urls(path), ['http://a/feed', 'http://c/feed'])
+
     def test_get_feed_by_url(self):
         feed_url = 'http://socketubs.org/atom.xml'
         self.bear.add_feed(feed_url)
@@ -41,6 +85,965 @@ class BearTestCase(unittest.TestCase):
         self.assertEqual(feed.url, feed_url)
 
 
+class SchedulerTestCase(unittest.TestCase):
+    class Feed(object):
+        id = 1
+        interval = None
+        next_poll = None
+        changed = None
+        errors = 0
+
+    def setUp(self):
+        self.scheduler = Scheduler(
+            min_interval=60, max_interval=3600, default_interval=600)
+        self.now = datetime(2014, 1, 6, 10, 0)
+
+    def test_busy_feed_polled_more_often(self):
+        feed = self.Feed()
+        feed.changed = self.now - timedelta(seconds=400)
+        self.scheduler.reschedule(feed, new_entries=4, now=self.now)
+        self.assertEqual(feed.interval, 350)
+        self.assertEqual(feed.next_poll, self.now + timedelta(seconds=350))
+
+    def test_quiet_feed_polled_less_often(self):
+        feed = self.Feed()
+        self.scheduler.reschedule(feed, now=self.now)
+        self.assertEqual(feed.interval, 900)
+        feed.interval = 3000
+        self.scheduler.reschedule(feed, now=self.now)
+        self.assertEqual(feed.interval, 3600)
+
+    def test_ttl_and_retry_after(self):
+        feed = self.Feed()
+        self.scheduler.reschedule(feed, ttl=30, now=self.now)
+        self.assertEqual(feed.interval, 1800)
+        self.scheduler.reschedule(feed, retry_after=7200, now=self.now)
+        self.assertEqual(feed.next_poll, self.now + timedelta(seconds=7200))
+
+    def test_errors_back_off(self):
+        feed = self.Feed()
+        self.scheduler.reschedule(feed, error=True, now=self.now)
+        self.assertEqual(feed.next_poll, self.now + timedelta(seconds=1200))
+        self.scheduler.reschedule(feed, error=True, now=self.now)
+        self.assertEqual(feed.next_poll, self.now + timedelta(seconds=2400))
+        self.assertEqual(feed.errors, 2)
+        self.scheduler.reschedule(feed, now=self.now)
+        self.assertEqual(feed.errors, 0)
+
+    def test_pop_due(self):
+        feeds = []
+        for i in range(3):
+            feed = self.Feed()
+            feed.id = i
+            feed.next_poll = self.now + timedelta(seconds=i * 60)
+            feeds.append(feed)
+        self.scheduler.load(reversed(feeds))
+        self.assertEqual(
+            self.scheduler.pop_due(self.now + timedelta(seconds=60)), [0, 1])
+        self.assertEqual(self.scheduler.next_due(), feeds[2].next_poll)
+
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+
+@unittest.skipIf(jinja2 is None, 'jinja2 not installed')
+class TemplatePluginTestCase(unittest.TestCase):
+    def setUp(self):
+        from bear.plugins.template import TemplatePlugin
+        from feedparser import FeedParserDict
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.template_file = os.path.join(self.tmp_dir, 'email.html')
+        self.write(self.template_file, '{{ entry.title }}', 1000)
+        os.mkdir(os.path.join(self.tmp_dir, 'feeds'))
+
+        self.plugin = TemplatePlugin(
+            subject='[{feed_parsed.feed.title}] {entry.title}',
+            template_file=self.template_file,
+            feed_templates=os.path.join(self.tmp_dir, 'feeds'),
+            digest_subject='{count} entries',
+            digest_template_file=os.path.join(self.tmp_dir, 'digest.html'),
+            cache_dir=os.path.join(self.tmp_dir, 'cache'))
+        self.feed = SchedulerTestCase.Feed()
+        self.feed_parsed = FeedParserDict(feed=FeedParserDict(title='A'))
+        self.entries = [FeedParserDict(title='a1'), FeedParserDict(title='a2')]
+
+    def write(self, path, content, mtime):
+        with open(path, 'w') as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def render(self):
+        return self.plugin.pre_send_email(
+            'from', 'to', 'subject', 'message',
+            self.feed, self.feed_parsed, self.entries[0])[2:4]
+
+    def test_render(self):
+        self.assertEqual(self.render(), ('[A] a1', 'a1'))
+
+    def test_reload_on_change(self):
+        self.render()
+        self.write(self.template_file, '<p>{{ entry.title }}</p>', 2000)
+        self.assertEqual(self.render()[1], '<p>a1</p>')
+
+    def test_no_template(self):
+        self.plugin.template_file = None
+        self.assertEqual(self.render(), ('[A] a1', 'message'))
+        self.assertIsNone(self.plugin.environment)
+
+    def test_feed_template(self):
+        self.write(os.path.join(self.tmp_dir, 'feeds', '1.html'),
+                   'feed {{ entry.title }}', 1000)
+        self.assertEqual(self.render()[1], 'feed a1')
+
+    def test_digest(self):
+        self.write(os.path.join(self.tmp_dir, 'digest.html'),
+                   '{% for e in entries %}{{ e.title }} {% endfor %}', 1000)
+        self.assertEqual(self.plugin.pre_send_digest(
+            'from', 'to', 'subject', 'message',
+            self.feed, self.feed_parsed, self.entries)[2:4],
+            ('2 entries', 'a1 a2 '))
+
+
+class FetchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_config_path = mkstemp()[1]
+        self.server = FeedServer()
+
+        self.bear = Bear(settings_path=self.tmp_config_path)
+        self.bear.config['settings']['db_path'] = ':memory:'
+        # Every test feed is on the same host
+        self.bear.config['fetch']['host_delay'] = '0'
+        self.bear.initialize_db()
+
+    def tearDown(self):
+        self.server.stop()
+        self.bear.close()
+        os.remove(self.tmp_config_path)
+
+    def test_fetch_feed(self):
+        self.server.feeds['/a.xml'] = make_rss('A', ['a2', 'a1'])
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        self.bear.fetch_feed(feed_id=feed_id)
+        feed = self.bear.get_feed(feed_id=feed_id)
+        self.assertEqual(feed.latest_id, 'a2')
+        self.assertIsNotNone(feed.updated)
+
+    def test_fetch_feed_seen_entries(self):
+        self.server.feeds['/a.xml'] = make_rss(
+            'A', ['a3', 'a2', 'a1'], updated='Mon, 06 Jan 2014 10:00:00 GMT')
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        self.bear.config['email']['to'] = 'foo@bar'
+        self.assertEqual(self.bear.fetch_feed(feed_id=feed_id), 3)
+
+        # Latest entry dropped out of the window and items reordered
+        self.server.feeds['/a.xml'] = make_rss(
+            'A', ['a1', 'a5', 'a4', 'a2'], updated='Tue, 07 Jan 2014 10:00:00 GMT')
+        self.assertEqual(self.bear.fetch_feed(feed_id=feed_id), 2)
+        self.assertEqual(self.bear.get_feed(feed_id=feed_id).latest_id, 'a5')
+
+        self.bear.reset_feed(feed_id=feed_id)
+        self.assertEqual(self.bear.fetch_feed(feed_id=feed_id), 4)
+
+    def test_fetch_stop_at_seen_entry(self):
+        self.server.gzip = True
+        self.server.feeds['/a.xml'] = make_rss('A', ['a3', 'a2', 'a1'])
+        d = fetch(self.server.url('/a.xml'), stop=lambda i: i == 'a2')
+        self.assertTrue(d.truncated)
+        self.assertFalse(d.bozo)
+        self.assertEqual(d.feed.title, 'A')
+        self.assertEqual([e.id for e in d.entries], ['a3'])
+
+        d = fetch(self.server.url('/a.xml'), stop=lambda i: False)
+        self.assertFalse(d.truncated)
+        self.assertEqual(len(d.entries), 3)
+
+    def test_fetch_stop_at_seen_rdf_entry(self):
+        items = ''.join(
+            '<item rdf:about="http://x/%s"><title>%s</title>'
+            '<link>http://x/%sl</link></item>' % (i, i, i) for i in (3, 2, 1))
+        self.server.feeds['/rdf.xml'] = (
+            '<?xml version="1.0"?><rdf:RDF'
+            ' xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"'
+            ' xmlns="http://purl.org/rss/1.0/"><channel rdf:about="http://x/">'
+            '<title>R</title><link>http://x/</link></channel>%s</rdf:RDF>' % items
+        ).encode('utf-8')
+        d = fetch(self.server.url('/rdf.xml'))
+        self.assertEqual([e.id for e in d.entries], ['http://x/3', 'http://x/2', 'http://x/1'])
+        d = fetch(self.server.url('/rdf.xml'), stop=lambda i: i == 'http://x/2')
+        self.assertTrue(d.truncated)
+        self.assertEqual([e.id for e in d.entries], ['http://x/3'])
+
+    def test_fetch_feed_too_large(self):
+        self.server.feeds['/a.xml'] = make_rss('A', ['a1'])
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        self.bear.config['fetch']['max_size'] = '100'
+        self.bear.fetch_feed(feed_id=feed_id)
+        feed = self.bear.get_feed(feed_id=feed_id)
+        self.assertEqual(feed.errors, 1)
+        self.assertIsNone(feed.updated)
+
+    def test_fetch_feed_not_modified(self):
+        self.server.feeds['/a.xml'] = make_rss('A', ['a1'])
+        self.server.etags['/a.xml'] = '"v1"'
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        self.bear.fetch_feed(feed_id=feed_id)
+        self.assertEqual(self.bear.get_feed(feed_id=feed_id).etag, '"v1"')
+
+        self.bear.fetch_feed(feed_id=feed_id)
+        self.assertEqual(
+            self.server.requests[-1][1].get('If-None-Match'), '"v1"')
+        self.assertEqual(self.bear.get_feed(feed_id=feed_id).latest_id, 'a1')
+
+    def test_fetch_feed_send_emails(self):
+        smtp = SMTPSink()
+        self.addCleanup(smtp.stop)
+        self.bear.config['email']['to'] = 'foo@bar'
+        self.bear.smtp_port = smtp.server_address[1]
+        self.bear.config['email']['max_per_connection'] = '2'
+        self.bear.config['email']['pool_size'] = '1'
+
+        self.server.feeds['/a.xml'] = make_rss('A', ['a3', 'a2', 'a1'])
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        self.assertEqual(self.bear.fetch_feed(feed_id=feed_id), 3)
+        self.assertEqual(len(smtp.messages), 3)
+        self.assertIn(b'Subject: [A] a1', smtp.messages[0])
+        self.assertEqual(smtp.connections, 2)
+
+    def test_fetch_feed_send_digest(self):
+        smtp = SMTPSink()
+        self.addCleanup(smtp.stop)
+        self.bear.config['email']['to'] = 'foo@bar'
+        self.bear.smtp_port = smtp.server_address[1]
+        self.bear.config['email']['batch'] = 'True'
+
+        self.server.feeds['/a.xml'] = make_rss('A', ['a2', 'a1'])
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        self.assertEqual(self.bear.fetch_feed(feed_id=feed_id), 1)
+        self.assertEqual(len(smtp.messages), 1)
+        self.assertIn(b'Subject: [A] 2 new entries', smtp.messages[0])
+
+    def test_flush_outbox_retry(self):
+        from bear.feed import Outbox
+        smtp = SMTPSink()
+        self.addCleanup(smtp.stop)
+        port = smtp.server_address[1]
+        smtp.stop()
+        self.bear.config['email']['to'] = 'foo@bar'
+        self.bear.config['email']['retry_delay'] = '0'
+        self.bear.smtp_port = port
+
+        self.server.feeds['/a.xml'] = make_rss('A', ['a2', 'a1'])
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        self.assertEqual(self.bear.fetch_feed(feed_id=feed_id), 2)
+        self.assertEqual(self.bear.get_feed(feed_id=feed_id).latest_id, 'a2')
+        self.assertEqual(
+            [m.attempts for m in Outbox.select()], [1, 1])
+
+        smtp = SMTPSink()
+        self.addCleanup(smtp.stop)
+        self.bear.mailer.port = smtp.server_address[1]
+        self.assertEqual(self.bear.flush_outbox(), 2)
+        self.assertEqual(len(smtp.messages), 2)
+        self.assertEqual(Outbox.select().count(), 0)
+
+    def test_mailer_unexpected_error(self):
+        from bear.mailer import Mailer
+
+        def connect():
+            raise ValueError('broken')
+        mailer = Mailer(pool_size=1)
+        self.addCleanup(mailer.close)
+        mailer.connect = connect
+        mailer.send('from', ['to'], 'message', message_id=1)
+        mailer.send('from', ['to'], 'message', message_id=2)
+        results = mailer.flush()
+        self.assertEqual([r[0] for r in results], [1, 2])
+        self.assertIsInstance(results[0][1], ValueError)
+
+    def test_mailer_flush_deadline(self):
+        from bear.mailer import Mailer
+
+        def connect():
+            time.sleep(0.5)
+            raise ValueError('slow')
+        mailer = Mailer(pool_size=1)
+        self.addCleanup(mailer.close)
+        mailer.connect = connect
+        for message_id in (1, 2, 3):
+            mailer.send('from', ['to'], 'message', message_id=message_id)
+        start = time.time()
+        results = mailer.flush(time.time() + 0.2)
+        self.assertLess(time.time() - start, 0.4)
+        # First one is still being sent, others are dropped
+        self.assertEqual(results, [(2, None, None), (3, None, None)])
+
+    def test_fetch_metrics(self):
+        metrics_path = mkstemp()[1]
+        prometheus_path = mkstemp()[1]
+        self.addCleanup(os.remove, metrics_path)
+        self.addCleanup(os.remove, prometheus_path)
+        self.bear.metrics.path = metrics_path
+        self.bear.metrics.prometheus_path = prometheus_path
+
+        self.server.feeds['/a.xml'] = make_rss('A', ['a2', 'a1'])
+        self.server.etags['/a.xml'] = '"v1"'
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        self.bear.config['email']['to'] = 'foo@bar'
+        self.bear.fetch_feed(feed_id=feed_id)
+        self.bear.fetch_feed(feed_id=feed_id)
+
+        stats = summarize(metrics_path)
+        self.assertEqual(stats['counters']['new_entries'], 2)
+        self.assertEqual(stats['counters']['emails'], 2)
+        self.assertEqual(stats['counters']['not_modified'], 1)
+        self.assertEqual(stats['feeds'][0][0], feed_id)
+        for stage in ('dns', 'download', 'parse', 'process', 'plugins', 'render'):
+            self.assertIn(stage, stats['stages'])
+        with open(prometheus_path) as f:
+            self.assertIn('bear_events{event="not_modified"} 1', f.read())
+
+    def test_run_pending(self):
+        self.server.feeds['/a.xml'] = make_rss('A', ['a1'])
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        self.bear.add_feed(self.server.url('/missing.xml'))
+
+        delay = self.bear.run_pending()
+        self.assertEqual(len(self.server.requests), 2)
+        feed = self.bear.get_feed(feed_id=feed_id)
+        self.assertEqual(feed.errors, 0)
+        self.assertIsNotNone(feed.next_poll)
+        self.assertGreater(delay, 60)
+
+        self.bear.run_pending()
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_unchanged_digest(self):
+        # No dates, feed would always look updated
+        self.server.feeds['/a.xml'] = make_rss('A', ['a2', 'a1'], updated='')
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        self.bear.config['email']['to'] = 'foo@bar'
+        for stream in ('False', 'True'):
+            self.bear.config['fetch']['stream'] = stream
+            self.bear.fetch_feed(feed_id=feed_id)
+            feed = self.bear.get_feed(feed_id=feed_id)
+            d = self.bear.parse_feed(feed, self.bear.seen_hashes(feed))
+            self.assertTrue(d.unchanged)
+            self.assertEqual(d.entries, [])
+            self.assertEqual(self.bear.fetch_feed(feed_id=feed_id), 0)
+
+        self.server.feeds['/a.xml'] = make_rss('A', ['a3', 'a2', 'a1'], updated='')
+        self.assertEqual(self.bear.fetch_feed(feed_id=feed_id), 1)
+
+    def test_new_entries_at_end(self):
+        self.bear.config['email']['to'] = 'foo@bar'
+        items = ['a1', 'a2', 'a3', 'a4', 'a5']
+        self.server.feeds['/a.xml'] = make_rss('A', items, updated='')
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        self.assertEqual(self.bear.fetch_feed(feed_id=feed_id), 5)
+        for item in ('a6', 'a7'):
+            # Oldest first, never read partially
+            items.append(item)
+            self.server.feeds['/a.xml'] = make_rss('A', items, updated='')
+            self.assertEqual(self.bear.fetch_feed(feed_id=feed_id), 1)
+            self.assertFalse(self.bear.get_feed(feed_id=feed_id).newest_first)
+
+    def test_stream_newest_first(self):
+        self.bear.config['email']['to'] = 'foo@bar'
+        self.server.feeds['/a.xml'] = make_rss('A', ['a2', 'a1'], updated='')
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        self.bear.fetch_feed(feed_id=feed_id)
+        feed = self.bear.get_feed(feed_id=feed_id)
+        self.assertIsNone(feed.newest_first)
+
+        # Order learnt from the first complete document with new entries
+        self.server.feeds['/a.xml'] = make_rss('A', ['a3', 'a2', 'a1'], updated='')
+        d = self.bear.parse_feed(feed, self.bear.seen_hashes(feed))
+        self.assertFalse(d.truncated)
+        self.assertEqual(self.bear.fetch_feed(feed_id=feed_id), 1)
+        feed = self.bear.get_feed(feed_id=feed_id)
+        self.assertTrue(feed.newest_first)
+
+        self.server.feeds['/a.xml'] = make_rss('A', ['a4', 'a3', 'a2', 'a1'], updated='')
+        d = self.bear.parse_feed(feed, self.bear.seen_hashes(feed))
+        self.assertTrue(d.truncated)
+        self.assertNotIn('a1', [e.id for e in d.entries])
+        self.assertEqual(self.bear.fetch_feed(feed_id=feed_id), 1)
+
+    def test_parsed_entries(self):
+        self.server.feeds['/a.xml'] = make_rss('A', ['a2', 'a1'])
+        feed = self.bear.get_feed(feed_id=self.bear.add_feed(self.server.url('/a.xml')))
+        d = self.bear.parse_feed(feed)
+        self.assertEqual(d.status, 200)
+        self.assertEqual(d.feed.title, 'A')
+        self.assertEqual(d.version, 'rss20')
+        self.assertEqual(d.get('encoding'), 'utf-8')
+        entry = d.entries[0]
+        self.assertEqual(entry.id, 'a2')
+        self.assertEqual(entry.title, 'a2')
+        self.assertEqual(entry.link, 'http://example.com/a2')
+        self.assertEqual(entry.description, 'a2 body')
+        # Other parsed fields are kept in a plain dict, slotted ones once
+        self.assertEqual(type(entry._data), dict)
+        self.assertNotIn('title', entry._data)
+        self.assertEqual(entry.links[0]['href'], 'http://example.com/a2')
+        self.assertEqual(entry.title_detail.value, 'a2')
+        self.assertEqual('{entry.title_detail.value}'.format(entry=entry), 'a2')
+        self.assertEqual(entry.summary, 'a2 body')
+        self.assertEqual(entry.get('guid'), 'a2')
+        self.assertIsNone(entry.get('published'))
+        self.assertNotIn('tags', entry)
+        self.assertRaises(AttributeError, getattr, entry, 'tags')
+        entry['summary_text'] = 'a2'
+        self.assertEqual(entry.summary_text, 'a2')
+
+    def test_feed_health(self):
+        self.bear.config['fetch']['max_errors'] = '2'
+        self.server.feeds['/a.xml'] = make_rss('A', ['a1'])
+        ok_id = self.bear.add_feed(self.server.url('/a.xml'))
+        dead_id = self.bear.add_feed(self.server.url('/dead.xml'))
+        self.bear.fetch_feeds()
+        ok, dead = self.bear.get_feed(feed_id=ok_id), self.bear.get_feed(feed_id=dead_id)
+        self.assertEqual((ok.last_status, ok.last_http_status), ('ok', 200))
+        self.assertIsNotNone(ok.last_success)
+        self.assertEqual((dead.last_status, dead.last_http_status), ('error', 404))
+        self.assertEqual(dead.last_error, 'HTTP 404')
+        self.assertIsNone(dead.last_success)
+
+        # Failing feeds wait for their backoff delay
+        self.bear.fetch_feeds()
+        self.assertEqual(len(self.server.requests), 3)
+        self.bear.fetch_feed(feed_id=dead_id)
+        dead = self.bear.get_feed(feed_id=dead_id)
+        self.assertEqual(dead.errors, 2)
+        self.assertTrue(dead.disabled)
+        self.assertEqual([f.id for f in self.bear.get_feeds(failing=True)], [dead_id])
+        # Same complete document on the second run
+        self.assertEqual(self.bear.health(), {'not_modified': 1, 'error': 1, 'disabled': 1})
+
+        dead.next_poll = datetime.now()
+        dead.save()
+        self.bear.fetch_feeds()
+        self.assertEqual(len(self.server.requests), 5)
+
+        # Enabled again once fetched successfully by hand
+        self.server.feeds['/dead.xml'] = make_rss('D', ['d1'])
+        self.bear.fetch_feed(feed_id=dead_id)
+        dead = self.bear.get_feed(feed_id=dead_id)
+        self.assertFalse(dead.disabled)
+        self.assertEqual(dead.errors, 0)
+        self.assertEqual(list(self.bear.get_feeds(failing=True)), [])
+
+    def test_response_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        cache = ResponseCache(tmp_dir, max_size=400, ttl=60)
+        cache.put('http://a/', {'etag': 'x'}, b'a' * 100)
+        headers, body, age = cache.get('http://a/')
+        self.assertEqual(headers, {'etag': 'x'})
+        self.assertEqual(body, b'a' * 100)
+        self.assertIsNone(cache.get('http://a/', max_age=-1))
+        self.assertIsNone(cache.get('http://b/'))
+
+        # Least recently used response evicted
+        os.utime(cache.key_path('http://a/'), (0, 0))
+        cache.put('http://b/', {}, b'b' * 100)
+        cache.get('http://a/')
+        cache.put('http://c/', {}, b'c' * 100)
+        self.assertIsNotNone(cache.get('http://a/'))
+        self.assertIsNone(cache.get('http://b/'))
+        self.assertIsNotNone(cache.get('http://c/'))
+
+    def test_fetch_from_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.bear.config['cache']['dir'] = tmp_dir
+        self.bear.config['email']['to'] = 'foo@bar'
+        self.server.feeds['/a.xml'] = make_rss('A', ['a2', 'a1'])
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        self.assertEqual(self.bear.fetch_feed(feed_id=feed_id), 2)
+
+        # Replayed without touching the server
+        self.bear.reset_feed(feed_id=feed_id)
+        self.assertEqual(self.bear.fetch_feed(feed_id=feed_id, from_cache=True), 2)
+        self.assertEqual(len(self.server.requests), 1)
+
+        # Too old, fetched again
+        self.bear.reset_feed(feed_id=feed_id)
+        self.assertEqual(self.bear.fetch_feed(
+            feed_id=feed_id, from_cache=True, max_age=-1), 2)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_host_politeness(self):
+        self.bear.config['fetch']['host_connections'] = '1'
+        for name in 'abc':
+            self.server.feeds['/%s.xml' % name] = make_rss(name, [name])
+            self.bear.add_feed(self.server.url('/%s.xml' % name))
+        self.server.statuses['/old.xml'] = (301, {'Location': '/a.xml'})
+        self.bear.add_feed(self.server.url('/old.xml'))
+
+        self.bear.fetch_feeds(workers=4)
+        # One kept-alive connection, redirect included
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.bear.get_feed(feed_id=4).latest_id, 'a')
+
+    def test_host_delay(self):
+        self.bear.config['fetch']['host_delay'] = '0.2'
+        self.bear.config['fetch']['host_connections'] = '4'
+        for name in 'abcd':
+            self.server.feeds['/%s.xml' % name] = make_rss(name, [name])
+            self.bear.add_feed(self.server.url('/%s.xml' % name))
+        start = time.time()
+        self.bear.fetch_feeds(workers=4)
+        self.assertGreaterEqual(time.time() - start, 0.6)
+
+    def test_host_slot_deadline(self):
+        from bear.hosts import Hosts
+        hosts = Hosts(max_connections=1, delay=0)
+        self.assertTrue(hosts.acquire('a'))
+        start = time.time()
+        self.assertFalse(hosts.acquire('a', time.time() + 0.2))
+        self.assertLess(time.time() - start, 0.4)
+        hosts.release('a')
+
+        # Delay between requests would end past the deadline
+        hosts = Hosts(delay=5)
+        self.assertTrue(hosts.acquire('a'))
+        hosts.release('a')
+        start = time.time()
+        self.assertFalse(hosts.acquire('a', time.time() + 1))
+        self.assertLess(time.time() - start, 0.2)
+
+    def test_retry_after_defers_host(self):
+        for name in 'ab':
+            self.server.feeds['/%s.xml' % name] = make_rss(name, [name])
+            self.bear.add_feed(self.server.url('/%s.xml' % name))
+        self.server.statuses['/a.xml'] = (429, {'Retry-After': '120'})
+
+        self.bear.fetch_feed(feed_id=1)
+        self.bear.fetch_feed(feed_id=2)
+        self.assertEqual([path for path, _ in self.server.requests], ['/a.xml'])
+        for feed in self.bear.get_feeds():
+            # Deferred, not counted as errors
+            self.assertEqual(feed.errors, 0)
+            self.assertFalse(feed.disabled)
+            self.assertGreater(feed.next_poll, datetime.now() + timedelta(seconds=100))
+            self.assertLess(feed.next_poll, datetime.now() + timedelta(seconds=130))
+
+        # Busy without Retry-After, polled again at its usual interval
+        self.server.statuses['/a.xml'] = (503, {})
+        self.bear.hosts.hosts.clear()
+        self.bear.fetch_feed(feed_id=1)
+        feed = self.bear.get_feed(feed_id=1)
+        self.assertEqual(feed.errors, 0)
+        self.assertGreater(feed.next_poll, datetime.now() + timedelta(seconds=1700))
+
+    def test_fetch_timeout(self):
+        self.server.delay = 2
+        self.bear.config['fetch']['timeout'] = '1'
+        self.server.feeds['/a.xml'] = make_rss('A', ['a1'])
+        feed_id = self.bear.add_feed(self.server.url('/a.xml'))
+        start = time.time()
+        self.bear.fetch_feed(feed_id=feed_id)
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(self.bear.get_feed(feed_id=feed_id).errors, 1)
+
+    def test_fetch_deadline(self):
+        self.server.delay = 0.4
+        self.bear.config['fetch']['host_connections'] = '1'
+        for name in 'abcd':
+            self.server.feeds['/%s.xml' % name] = make_rss(name, [name])
+            self.bear.add_feed(self.server.url('/%s.xml' % name))
+
+        start = time.time()
+        self.bear.fetch_feeds(workers=1, deadline=0.6)
+        self.assertLess(time.time() - start, 1)
+        feeds = list(self.bear.get_feeds())
+        self.assertIsNotNone(feeds[0].updated)
+        for feed in feeds[1:]:
+            # Deferred, not failed, and due on next run
+            self.assertIsNone(feed.updated)
+            self.assertEqual(feed.errors, 0)
+            self.assertIsNone(feed.locked_by)
+            self.assertLessEqual(feed.next_poll, datetime.now())
+
+        self.server.delay = 0
+        self.bear.fetch_feeds(workers=1)
+        for feed in self.bear.get_feeds():
+            self.assertIsNotNone(feed.updated)
+
+    def test_run_lock(self):
+        path = mkstemp()[1]
+        self.addCleanup(os.remove, path)
+        self.bear.config['settings']['lock_file'] = path
+        lock = self.bear.run_lock()
+        self.assertTrue(lock.acquire())
+        other = self.bear.run_lock()
+        self.assertFalse(other.acquire())
+        lock.release()
+        with other as acquired:
+            self.assertTrue(acquired)
+
+    def test_fetch_feeds_concurrently(self):
+        self.server.delay = 0.3
+        self.bear.config['fetch']['host_connections'] = '4'
+        for name in 'abcd':
+            self.server.feeds['/%s.xml' % name] = make_rss(name, [name])
+            self.bear.add_feed(self.server.url('/%s.xml' % name))
+
+        start = time.time()
+        self.bear.fetch_feeds(workers=4)
+        self.assertLess(time.time() - start, 4 * self.server.delay)
+        for feed in self.bear.get_feeds():
+            self.assertIsNotNone(feed.updated)
+
+    def test_fetch_feeds_across_claims(self):
+        # Next lease batch is claimed as soon as a worker is free
+        self.server.delay = 0.3
+        self.bear.config['fetch']['host_connections'] = '4'
+        self.bear.config['cluster']['claim_size'] = '1'
+        for name in 'abcd':
+            self.server.feeds['/%s.xml' % name] = make_rss(name, [name])
+            self.bear.add_feed(self.server.url('/%s.xml' % name))
+
+        start = time.time()
+        self.bear.fetch_feeds(workers=4)
+        self.assertLess(time.time() - start, 3 * self.server.delay)
+        self.assertEqual(len(self.server.requests), 4)
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_config_path = mkstemp()[1]
+        self.tmp_db_path = mkstemp()[1]
+        os.remove(self.tmp_db_path)
+
+        self.bear = Bear(settings_path=self.tmp_config_path)
+        self.bear.config['settings']['db_path'] = self.tmp_db_path
+
+    def tearDown(self):
+        self.bear.close()
+        os.remove(self.tmp_config_path)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.tmp_db_path + suffix):
+                os.remove(self.tmp_db_path + suffix)
+
+    def test_pragmas(self):
+        self.bear.initialize_db()
+        self.assertEqual(self.bear.db.journal_mode, 'wal')
+        self.assertEqual(self.bear.db.synchronous, 1)
+
+    def test_fresh_database_up_to_date(self):
+        from bear.migrations import MIGRATIONS, SchemaVersion
+        self.bear.initialize_db()
+        self.assertEqual(SchemaVersion.select().count(), len(MIGRATIONS))
+
+    def test_migrate_legacy_database(self):
+        import sqlite3
+        from bear.migrations import MIGRATIONS, SchemaVersion
+        conn = sqlite3.connect(self.tmp_db_path)
+        conn.execute(
+            'CREATE TABLE feed (id INTEGER NOT NULL PRIMARY KEY, '
+            'url VARCHAR(255) NOT NULL, added DATETIME NOT NULL, '
+            'updated DATETIME, latest_id VARCHAR(255))')
+        conn.execute(
+            "INSERT INTO feed (url, added) VALUES ('http://a', '2014-01-06')")
+        conn.commit()
+        conn.close()
+
+        self.bear.initialize_db()
+        self.assertEqual(SchemaVersion.select().count(), len(MIGRATIONS))
+        columns = [c.name for c in self.bear.db.get_columns('feed')]
+        self.assertIn('next_poll', columns)
+        self.assertIn('outbox_status_next_attempt', [
+            i.name for i in self.bear.db.get_indexes('outbox')])
+        self.assertEqual(self.bear.get_feed(feed_id=1).errors, 0)
+
+    def test_several_instances(self):
+        # In-memory database next to a "remote" one, shared by two instances
+        self.bear.config['settings']['db_path'] = ':memory:'
+        self.bear.initialize_db()
+        remotes = []
+        for _ in range(2):
+            remote = Bear(settings_path=self.tmp_config_path)
+            remote.config['settings']['db_url'] = 'sqlite:///%s' % self.tmp_db_path
+            remote.initialize_db()
+            remotes.append(remote)
+
+        self.bear.add_feed('http://local/feed')
+        remotes[0].add_feed('http://remote/feed')
+        self.assertEqual(
+            [f.url for f in self.bear.get_feeds()], ['http://local/feed'])
+        self.assertEqual(
+            remotes[1].get_feed(url='http://remote/feed').id, 1)
+        self.assertIsNone(remotes[1].get_feed(url='http://local/feed'))
+        self.assertEqual(remotes[1].db.journal_mode, 'wal')
+        for remote in remotes:
+            remote.close()
+
+    def test_instances_in_threads(self):
+        import threading
+        bears = []
+        for i in range(2):
+            path = '%s-%s' % (self.tmp_db_path, i)
+            for suffix in ('', '-wal', '-shm'):
+                self.addCleanup(lambda p=path + suffix: os.path.exists(p) and os.remove(p))
+            bear = Bear(settings_path=self.tmp_config_path)
+            bear.config['settings']['db_path'] = path
+            bear.initialize_db()
+            self.addCleanup(bear.close)
+            bears.append(bear)
+
+        def add_feeds(i):
+            for j in range(300):
+                bears[i].add_feed('http://%s/%s' % (i, j))
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+        threads = [threading.Thread(target=add_feeds, args=(i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for i, bear in enumerate(bears):
+            urls = [f.url for f in bear.get_feeds()]
+            self.assertEqual(len(urls), 300)
+            self.assertTrue(all(url.startswith('http://%s/' % i) for url in urls))
+
+
+def fetch_all(settings_path):
+    bear = Bear(settings_path=settings_path)
+    bear.initialize_db()
+    bear.fetch_feeds()
+    bear.close()
+
+
+class ClusterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_config_path = mkstemp()[1]
+        self.tmp_db_path = mkstemp()[1]
+        os.remove(self.tmp_db_path)
+        self.server = FeedServer()
+
+        bear = Bear(settings_path=self.tmp_config_path)
+        bear.config['settings']['db_url'] = 'sqlite:///%s' % self.tmp_db_path
+        bear.config['settings']['log_file'] = ''
+        bear.config['cluster']['claim_size'] = '2'
+        bear.config['fetch']['host_delay'] = '0'
+        bear.initialize_config()
+        self.bears = []
+
+    def tearDown(self):
+        for bear in self.bears:
+            bear.close()
+        self.server.stop()
+        os.remove(self.tmp_config_path)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.tmp_db_path + suffix):
+                os.remove(self.tmp_db_path + suffix)
+
+    def make_bear(self, shard=''):
+        bear = Bear(settings_path=self.tmp_config_path,
+                    cli_opts={'--shard': shard})
+        bear.initialize_db()
+        self.bears.append(bear)
+        return bear
+
+    def test_claim_feeds(self):
+        from bear.feed import Feed
+        a, b = self.make_bear(), self.make_bear()
+        a.import_feeds(['http://a/%s' % i for i in range(4)])
+
+        self.assertEqual(len(a.claim_feeds(3)), 3)
+        claimed = b.claim_feeds(10)
+        self.assertEqual([f.id for f in claimed], [4])
+        self.assertEqual(b.claim_feeds(10), [])
+
+        # a crashed, its leases expire
+        Feed.update(lease_until=datetime.now() - timedelta(seconds=1)).where(
+            Feed.locked_by == a.node).execute()
+        self.assertEqual([f.id for f in b.claim_feeds(10)], [1, 2, 3])
+        self.assertEqual(b.get_feeds().where(Feed.locked_by == b.node).count(), 4)
+
+    def test_shards(self):
+        a, b = self.make_bear('0/2'), self.make_bear('1/2')
+        a.import_feeds(['http://a/%s' % i for i in range(6)])
+        self.assertEqual([f.id for f in a.claim_feeds(10)], [2, 4, 6])
+        self.assertEqual([f.id for f in b.claim_feeds(10)], [1, 3, 5])
+
+    def test_fetch_all_processes(self):
+        import multiprocessing
+        self.server.delay = 0.05
+        bear = self.make_bear()
+        for i in range(12):
+            self.server.feeds['/%s.xml' % i] = make_rss(str(i), ['%s-1' % i])
+            bear.add_feed(self.server.url('/%s.xml' % i))
+
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=fetch_all, args=(self.tmp_config_path,))
+                     for _ in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        paths = sorted(path for path, headers in self.server.requests)
+        self.assertEqual(paths, sorted('/%s.xml' % i for i in range(12)))
+        for feed in bear.get_feeds():
+            self.assertIsNone(feed.locked_by)
+            self.assertIsNotNone(feed.last_polled)
+            self.assertEqual(feed.latest_id, '%s-1' % (feed.id - 1))
+
+
+class GuesserPluginTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_config_path = mkstemp()[1]
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = FeedServer()
+        self.server.feeds['/a.xml'] = make_rss('A', ['a1'])
+        self.server.feeds['/blog'] = (
+            b'<html><head><title>Blog</title>'
+            b'<link rel="stylesheet" href="/style.css">'
+            b'<link rel="alternate" type="application/rss+xml" href="/a.xml">'
+            b'</head><body></body></html>')
+        self.server.feeds['/site'] = b'<html><head></head><body>Site</body></html>'
+        self.server.feeds['/atom.xml'] = make_rss('Atom', ['b1'])
+
+        self.bear = Bear(settings_path=self.tmp_config_path)
+        self.bear.config['settings']['db_path'] = ':memory:'
+        self.bear.initialize_db()
+
+    def tearDown(self):
+        self.server.stop()
+        self.bear.close()
+        shutil.rmtree(self.tmp_dir)
+        os.remove(self.tmp_config_path)
+
+    def plugin(self, **kwargs):
+        from bear.plugins.guesser import GuesserPlugin
+        kwargs.setdefault('cache_file', os.path.join(self.tmp_dir, 'guesser.json'))
+        return GuesserPlugin(**kwargs)
+
+    def test_guess(self):
+        plugin = self.plugin()
+        url = self.server.url
+        self.assertEqual(plugin.pre_add_feed(url('/a.xml')), url('/a.xml'))
+        self.assertEqual(plugin.pre_add_feed(url('/blog')), url('/a.xml'))
+        self.assertEqual(plugin.pre_add_feed(url('/site')), url('/atom.xml'))
+        # Added as given when no feed is found
+        plugin = self.plugin(paths='/feed,/rss', cache_file='')
+        self.assertEqual(plugin.pre_add_feed(url('/site')), url('/site'))
+
+    def test_cache(self):
+        url = self.server.url
+        self.plugin(paths='/feed').pre_add_feeds([url('/blog'), url('/site')])
+        count = len(self.server.requests)
+
+        # Found and missing feeds resolved again from the cache file
+        plugin = self.plugin(paths='/feed')
+        self.assertEqual(plugin.pre_add_feed(url('/blog')), url('/a.xml'))
+        self.assertEqual(plugin.pre_add_feed(url('/a.xml')), url('/a.xml'))
+        self.assertEqual(plugin.pre_add_feed(url('/site')), url('/site'))
+        self.assertEqual(len(self.server.requests), count)
+
+        plugin = self.plugin(paths='/feed', negative_ttl='-1')
+        self.assertEqual(plugin.pre_add_feed(url('/blog')), url('/a.xml'))
+        self.assertEqual(plugin.pre_add_feed(url('/site')), url('/site'))
+        self.assertEqual(len(self.server.requests), count + 2)
+
+    def test_import_feeds_concurrently(self):
+        self.server.delay = 0.2
+        urls = []
+        for i in range(8):
+            self.server.feeds['/blog-%s' % i] = self.server.feeds['/blog'].replace(
+                b'/a.xml', b'/%s.xml' % str(i).encode('utf-8'))
+            urls.append(self.server.url('/blog-%s' % i))
+        self.bear.plugin_manager = PluginManager({'guesser': {
+            'cache_file': os.path.join(self.tmp_dir, 'guesser.json')}})
+
+        start = time.time()
+        self.bear.import_feeds(urls)
+        self.assertLess(time.time() - start, 8 * self.server.delay)
+        self.assertEqual(
+            sorted(feed.url for feed in self.bear.get_feeds()),
+            sorted(self.server.url('/%s.xml' % i) for i in range(8)))
+
+
+class SummarizePluginTestCase(unittest.TestCase):
+    def test_summarize(self):
+        from bear.plugins.summarize import summarize
+        html = (
+            '<html><head><title>Title</title><style>p { }</style></head><body>'
+            '<p>Hello &amp; welcome.</p><script>var p = "<p>no</p>";</script>'
+            '<img src="data:image/png;base64,%s"><p>Second  one! Third? Fourth.</p>'
+            '</body></html>' % ('A' * 100000))
+        self.assertEqual(summarize(html), 'Hello & welcome. Second one! Third?')
+        self.assertEqual(
+            summarize(html, max_sentences=0),
+            'Hello & welcome. Second one! Third? Fourth.')
+        self.assertEqual(
+            summarize('<p>%s</p>' % ('word ' * 100000), max_length=20),
+            u'word word word word…')
+        self.assertEqual(summarize(
+            'see data:image/gif;base64,R0lGOD= <b>bold</b>text<br>line <!-- x --> end <a href="x"',
+            max_sentences=0), 'see boldtext line end')
+        self.assertEqual(summarize(
+            '<p>Big data: the future of metadata:tags. Second one.</p>', 500, 0),
+            'Big data: the future of metadata:tags. Second one.')
+
+    def test_pre_send_email(self):
+        import feedparser
+        from bear.core import email_body
+        from bear.core import digest_body
+        from bear.plugins.summarize import SummarizePlugin
+        plugin = SummarizePlugin(max_sentences='1')
+        entry = feedparser.FeedParserDict(
+            link='http://a/1', title='A <1>',
+            description='<p>One &lt;b&gt;. Two.</p>')
+        message = plugin.pre_send_email(
+            'from', 'to', 'subject', email_body(entry), None, None, entry)[3]
+        self.assertIn('<p>One &lt;b&gt;.</p>', message)
+        self.assertEqual(entry.summary_text, 'One <b>.')
+        message = plugin.pre_send_digest(
+            'from', 'to', 'subject', digest_body([entry]), None, None, [entry])[3]
+        self.assertIn('<a href="http://a/1">A <1></a></h3><p>One &lt;b&gt;.</p>', message)
+
+        # Messages rendered by a template are kept
+        self.assertEqual(plugin.pre_send_email(
+            'from', 'to', 'subject', 'template', None, None, entry)[3], 'template')
+
+
+class UpperPlugin(BasePlugin):
+    def pre_add_feed(self, url):
+        return url.upper()
+
+    def pre_delete_feed(self, feed):
+        raise NotImplementedError
+
+
+class ObserverPlugin(BasePlugin):
+    def __init__(self, delay=0, **kwargs):
+        super().__init__(**kwargs)
+        self.delay = delay
+        self.seen = []
+
+    @observer
+    def post_add_feed(self, feed):
+        time.sleep(self.delay)
+        self.seen.append(feed.url)
+        return 'ignored'
+
+    @observer
+    def post_delete_feed(self, feed):
+        raise ValueError('broken')
+
+
 class PluginManagerTestCase(unittest.TestCase):
     def setUp(self):
         self.tmp_config_path = mkstemp()[1]
@@ -53,5 +1056,59 @@ class PluginManagerTestCase(unittest.TestCase):
         self.bear.db.close()
         os.remove(self.tmp_config_path)
 
+    def test_hooks_only_overridden(self):
+        manager = PluginManager({'missing': {}})
+        manager.plugins['base'] = BasePlugin()
+        manager.plugins['upper'] = UpperPlugin()
+        manager.compile_hooks()
+        self.assertEqual(
+            [name for name, _ in manager.hooks['pre_add_feed']], ['upper'])
+        self.assertNotIn('pre_send_email', manager.hooks)
+
+    def test_observers(self):
+        manager = PluginManager({}, timeout=1)
+        manager.plugins['observer'] = plugin = ObserverPlugin(delay=0.5)
+        manager.plugins['upper'] = UpperPlugin()
+        manager.compile_hooks()
+        self.assertNotIn('post_add_feed', manager.hooks)
+        self.bear.plugin_manager = manager
+
+        start = time.time()
+        feed_id = self.bear.add_feed('http://a')
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(plugin.seen, [])
+        # Errors are isolated, the caller gets its args back
+        feed = self.bear.get_feed(feed_id=feed_id)
+        self.assertEqual(manager.run_signal('post_delete_feed', feed), feed)
+        self.assertTrue(manager.observers.join(2))
+        self.assertEqual(plugin.seen, ['HTTP://A'])
+
+        # Hung hooks don't hold close() longer than timeout
+        plugin.delay = 3
+        manager.run_signal('post_add_feed', feed)
+        start = time.time()
+        manager.close()
+        self.assertLess(time.time() - start, 2)
+
+    def test_hung_observer(self):
+        from bear.plugins.manager import Observers
+        observers = Observers(workers=1, timeout=0.5)
+        self.addCleanup(observers.close)
+        seen = []
+        observers.submit('hung', 'post_add_feed', time.sleep, (3,))
+        observers.submit('quick', 'post_add_feed', seen.append, ('a',))
+        # Hung worker is replaced, next hooks still run
+        self.assertTrue(observers.join(2))
+        self.assertEqual(seen, ['a'])
+
+    def test_run_signal(self):
+        manager = PluginManager({})
+        manager.plugins['upper'] = UpperPlugin()
+        manager.compile_hooks()
+        self.assertEqual(manager.run_signal('pre_add_feed', 'http://a'), 'HTTP://A')
+        self.assertEqual(manager.run_signal('pre_delete_feed', None), None)
+        self.assertEqual(
+            manager.run_signal('pre_send_email', 1, 2, 3), (1, 2, 3))
+
 if __name__ == '__main__':
     unittest.main()